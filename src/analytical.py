@@ -1,16 +1,47 @@
 """
 Functions that provide analytical formulas for evaluation of the expectation values in QAOA.
 """
-import math
+from __future__ import annotations
+
+from dataclasses import dataclass
 
-import networkx as nx
 import numpy as np
 from networkx import Graph
+from numba import njit
 from numpy import ndarray, sin, cos
 
 from src.graph_utils import get_index_edge_list
 
 
+@njit(fastmath=True, cache=True)
+def calc_expectation_general_analytical_z1_arrays(angles: ndarray, index_edges: ndarray, num_nodes: int) -> float:
+    """
+    Calculates target expectation for given angles with Generalized first-order QAOA ansatz via an analytical formula (for p=1).
+    :param angles: 1D array of all angles for the first GQAOA layer in the same order as in `get_evaluator_general`.
+    :param index_edges: 2D array of size #edges x 2 with edges specified by node indices (see `get_index_edge_list`).
+    :param num_nodes: Number of nodes in the graph.
+    :return: Target expectation value for the given angles.
+    """
+    expectation = len(index_edges) / 2
+    for i in range(len(index_edges)):
+        u, v = index_edges[i]
+        expectation -= sin(2 * angles[u]) * sin(2 * angles[v]) * sin(2 * angles[u + num_nodes]) * sin(2 * angles[v + num_nodes]) / 2
+    return expectation
+
+
+@njit(fastmath=True, cache=True)
+def calc_expectation_general_analytical_z1_reduced_arrays(angles: ndarray, index_edges: ndarray, num_nodes: int) -> float:
+    """
+    A version of `calc_expectation_general_analytical_z1_arrays` that fixes all betas and varies gammas only.
+    :param angles: 1D array of the angles that are not fixed.
+    :param index_edges: 2D array of size #edges x 2 with edges specified by node indices (see `get_index_edge_list`).
+    :param num_nodes: Number of nodes in the graph.
+    :return: Target expectation value for the given angles.
+    """
+    full_angles = np.concatenate((np.full(num_nodes, np.pi / 4), angles))
+    return calc_expectation_general_analytical_z1_arrays(full_angles, index_edges, num_nodes)
+
+
 def calc_expectation_general_analytical_z1(angles: ndarray, graph: Graph) -> float:
     """
     Calculates target expectation for given angles with Generalized first-order QAOA ansatz via an analytical formula (for p=1).
@@ -18,12 +49,7 @@ def calc_expectation_general_analytical_z1(angles: ndarray, graph: Graph) -> flo
     :param graph: Graph for which MaxCut problem is being solved.
     :return: Target expectation value for the given angles.
     """
-    expectation = len(graph.edges) / 2
-    for edge in get_index_edge_list(graph):
-        gammas = angles[edge]
-        betas = angles[edge + len(graph)]
-        expectation -= sin(2 * betas[0]) * sin(2 * betas[1]) * sin(2 * gammas[0]) * sin(2 * gammas[1]) / 2
-    return expectation
+    return calc_expectation_general_analytical_z1_arrays(np.asarray(angles, dtype=float), get_index_edge_list(graph), len(graph))
 
 
 def calc_expectation_general_analytical_z1_reduced(angles: ndarray, graph: Graph) -> float:
@@ -33,62 +59,285 @@ def calc_expectation_general_analytical_z1_reduced(angles: ndarray, graph: Graph
     :param graph: Graph for which MaxCut problem is being solved.
     :return: Target expectation value for the given angles.
     """
-    full_angles = np.array([np.pi / 4] * len(graph) + list(angles))
-    return calc_expectation_general_analytical_z1(full_angles, graph)
+    return calc_expectation_general_analytical_z1_reduced_arrays(np.asarray(angles, dtype=float), get_index_edge_list(graph), len(graph))
+
+
+@dataclass
+class TopologyP1:
+    """
+    Graph topology required by the analytical formula for MA-QAOA expectation at p=1. Neighbouring edges are referred to by their indices in graph.edges.
+    Lists of neighbouring edges have different lengths for different edges, so they are padded to the same length with index len(graph.edges), which refers to an extra zero angle.
+    :var edge_weights: 1D array of weights of all edges in the order of graph.edges. Edge angles are multiplied by these weights.
+    :var edges: 2D array of size len(edge_list) x 2 with the nodes of each considered edge (u, v).
+    :var edge_inds: 1D array with index of each considered edge in graph.edges.
+    :var d_inds: 2D array with indices of edges (u, m) for each considered edge, where m is a neighbour of u, but not of v.
+    :var e_inds: 2D array with indices of edges (v, m) for each considered edge, where m is a neighbour of v, but not of u.
+    :var f_inds_u: 2D array with indices of edges (u, m) for each considered edge, where m is a common neighbour of u and v.
+    :var f_inds_v: 2D array with indices of edges (v, m) for each considered edge, in the same order of m as in f_inds_u.
+    """
+    edge_weights: ndarray
+    edges: ndarray
+    edge_inds: ndarray
+    d_inds: ndarray
+    e_inds: ndarray
+    f_inds_u: ndarray
+    f_inds_v: ndarray
+
+    @staticmethod
+    def create(graph: Graph, edge_list: list[tuple[int, int]] = None) -> TopologyP1:
+        """
+        Creates an instance of TopologyP1.
+        :param graph: Graph for which MaxCut problem is being solved.
+        :param edge_list: List of edges that should be taken into account when calculating expectation value. If None, then all edges are taken into account.
+        :return: Instance of TopologyP1 class.
+        """
+        if edge_list is None:
+            edge_list = graph.edges
+
+        edge_weights = np.array([w for _, _, w in graph.edges.data('weight')])
+        edge_ind_map = {}
+        for ind, (u, v) in enumerate(graph.edges):
+            edge_ind_map[(u, v)] = ind
+            edge_ind_map[(v, u)] = ind
+
+        edges, edge_inds, d_inds, e_inds, f_inds_u, f_inds_v = [], [], [], [], [], []
+        for u, v in edge_list:
+            d = set(graph[u]) - {v}
+            e = set(graph[v]) - {u}
+            f = list(d & e)
+            edges.append([u, v])
+            edge_inds.append(edge_ind_map[(u, v)])
+            d_inds.append([edge_ind_map[(u, m)] for m in d - set(f)])
+            e_inds.append([edge_ind_map[(v, m)] for m in e - set(f)])
+            f_inds_u.append([edge_ind_map[(u, m)] for m in f])
+            f_inds_v.append([edge_ind_map[(v, m)] for m in f])
+
+        pad_ind = len(graph.edges)
+        return TopologyP1(edge_weights, np.array(edges, dtype=int).reshape((-1, 2)), np.array(edge_inds, dtype=int), pad_index_lists(d_inds, pad_ind),
+                          pad_index_lists(e_inds, pad_ind), pad_index_lists(f_inds_u, pad_ind), pad_index_lists(f_inds_v, pad_ind))
+
+
+def pad_index_lists(index_lists: list[list[int]], pad_ind: int) -> ndarray:
+    """
+    Pads index lists of different lengths to the same length and stacks them into a 2D array.
+    :param index_lists: List of index lists.
+    :param pad_ind: Index used for padding.
+    :return: 2D array of size len(index_lists) x max length of the index lists.
+    """
+    max_len = max([len(inds) for inds in index_lists], default=0)
+    res = np.full((len(index_lists), max_len), pad_ind, dtype=int)
+    for i, inds in enumerate(index_lists):
+        res[i, :len(inds)] = inds
+    return res
+
+
+@njit(fastmath=True, cache=True)
+def calc_expectation_ma_qaoa_analytical_p1_arrays(angles: ndarray, edge_weights: ndarray, edges: ndarray, edge_inds: ndarray, d_inds: ndarray, e_inds: ndarray,
+                                                  f_inds_u: ndarray, f_inds_v: ndarray) -> float:
+    """
+    Compiled implementation of `calc_expectation_ma_qaoa_analytical_p1`. Accepts the fields of `TopologyP1` as separate arrays.
+    Padded entries of neighbour lists refer to zero angle, so they contribute 1 to all cosine products and cancel out in the triangle terms.
+    """
+    num_edges = len(edge_weights)
+    gammas = np.zeros(num_edges + 1)
+    gammas[:num_edges] = angles[:num_edges] * edge_weights
+    betas = angles[num_edges:]
+
+    objective = 0.
+    for i in range(len(edge_inds)):
+        w = edge_weights[edge_inds[i]]
+        sin_u = sin(2 * betas[edges[i, 0]])
+        cos_u = cos(2 * betas[edges[i, 0]])
+        sin_v = sin(2 * betas[edges[i, 1]])
+        cos_v = cos(2 * betas[edges[i, 1]])
+
+        cos_prod_d = 1.
+        for j in range(d_inds.shape[1]):
+            cos_prod_d *= cos(gammas[d_inds[i, j]])
+        cos_prod_e = 1.
+        for j in range(e_inds.shape[1]):
+            cos_prod_e *= cos(gammas[e_inds[i, j]])
+
+        # Triangle terms
+        cos_prod_f_plus = 1.
+        cos_prod_f_minus = 1.
+        cos_prod_f_u = 1.
+        cos_prod_f_v = 1.
+        for j in range(f_inds_u.shape[1]):
+            gamma_u = gammas[f_inds_u[i, j]]
+            gamma_v = gammas[f_inds_v[i, j]]
+            cos_prod_f_plus *= cos(gamma_u + gamma_v)
+            cos_prod_f_minus *= cos(gamma_u - gamma_v)
+            cos_prod_f_u *= cos(gamma_u)
+            cos_prod_f_v *= cos(gamma_v)
+
+        objective += w / 2 + w / 4 * sin_u * sin_v * cos_prod_d * cos_prod_e * (cos_prod_f_plus - cos_prod_f_minus) + \
+            w / 2 * sin(gammas[edge_inds[i]]) * (sin_u * cos_v * cos_prod_d * cos_prod_f_u + cos_u * sin_v * cos_prod_e * cos_prod_f_v)
+    return objective
+
+
+@njit(fastmath=True, cache=True)
+def calc_cos_prod_derivatives(xs: ndarray) -> ndarray:
+    """
+    Calculates partial derivatives of the product of cosines of the given values.
+    :param xs: 1D array of values.
+    :return: 1D array of the same size as xs, where element j is the derivative of prod(cos(xs)) with respect to xs[j].
+    """
+    res = -np.sin(xs)
+    for j in range(len(xs)):
+        for k in range(len(xs)):
+            if k != j:
+                res[j] *= cos(xs[k])
+    return res
+
+
+@njit(fastmath=True, cache=True)
+def calc_gradient_ma_qaoa_analytical_p1_arrays(angles: ndarray, edge_weights: ndarray, edges: ndarray, edge_inds: ndarray, d_inds: ndarray, e_inds: ndarray,
+                                               f_inds_u: ndarray, f_inds_v: ndarray) -> ndarray:
+    """
+    Compiled implementation of `calc_gradient_ma_qaoa_analytical_p1`. Accepts the fields of `TopologyP1` as separate arrays.
+    Derivatives with respect to the padded entries of neighbour lists are accumulated in an extra element, which is then discarded.
+    """
+    num_edges = len(edge_weights)
+    gammas = np.zeros(num_edges + 1)
+    gammas[:num_edges] = angles[:num_edges] * edge_weights
+    betas = angles[num_edges:]
 
+    grad_gammas = np.zeros(num_edges + 1)
+    grad_betas = np.zeros(len(betas))
+    for i in range(len(edge_inds)):
+        u = edges[i, 0]
+        v = edges[i, 1]
+        w = edge_weights[edge_inds[i]]
+        sin_u = sin(2 * betas[u])
+        cos_u = cos(2 * betas[u])
+        sin_v = sin(2 * betas[v])
+        cos_v = cos(2 * betas[v])
+        sin_uv = sin(gammas[edge_inds[i]])
 
-def calc_expectation_ma_qaoa_analytical_p1(angles: ndarray, graph: Graph, edge_list: list[tuple[int, int]] = None) -> float:
+        gammas_d = gammas[d_inds[i]]
+        gammas_e = gammas[e_inds[i]]
+        gammas_f_u = gammas[f_inds_u[i]]
+        gammas_f_v = gammas[f_inds_v[i]]
+        cos_prod_d = np.prod(np.cos(gammas_d))
+        cos_prod_e = np.prod(np.cos(gammas_e))
+        cos_prod_f_diff = np.prod(np.cos(gammas_f_u + gammas_f_v)) - np.prod(np.cos(gammas_f_u - gammas_f_v))
+        cos_prod_f_u = np.prod(np.cos(gammas_f_u))
+        cos_prod_f_v = np.prod(np.cos(gammas_f_v))
+
+        grad_gammas[edge_inds[i]] += w / 2 * cos(gammas[edge_inds[i]]) * (sin_u * cos_v * cos_prod_d * cos_prod_f_u + cos_u * sin_v * cos_prod_e * cos_prod_f_v)
+        grad_betas[u] += w / 2 * cos_u * sin_v * cos_prod_d * cos_prod_e * cos_prod_f_diff + \
+            w * sin_uv * (cos_u * cos_v * cos_prod_d * cos_prod_f_u - sin_u * sin_v * cos_prod_e * cos_prod_f_v)
+        grad_betas[v] += w / 2 * sin_u * cos_v * cos_prod_d * cos_prod_e * cos_prod_f_diff + \
+            w * sin_uv * (-sin_u * sin_v * cos_prod_d * cos_prod_f_u + cos_u * cos_v * cos_prod_e * cos_prod_f_v)
+
+        cos_prod_derivs_d = calc_cos_prod_derivatives(gammas_d)
+        for j in range(len(gammas_d)):
+            grad_gammas[d_inds[i, j]] += cos_prod_derivs_d[j] * (w / 4 * sin_u * sin_v * cos_prod_e * cos_prod_f_diff + w / 2 * sin_uv * sin_u * cos_v * cos_prod_f_u)
+        cos_prod_derivs_e = calc_cos_prod_derivatives(gammas_e)
+        for j in range(len(gammas_e)):
+            grad_gammas[e_inds[i, j]] += cos_prod_derivs_e[j] * (w / 4 * sin_u * sin_v * cos_prod_d * cos_prod_f_diff + w / 2 * sin_uv * cos_u * sin_v * cos_prod_f_v)
+
+        # Triangle terms
+        cos_prod_derivs_f_plus = calc_cos_prod_derivatives(gammas_f_u + gammas_f_v)
+        cos_prod_derivs_f_minus = calc_cos_prod_derivatives(gammas_f_u - gammas_f_v)
+        cos_prod_derivs_f_u = calc_cos_prod_derivatives(gammas_f_u)
+        cos_prod_derivs_f_v = calc_cos_prod_derivatives(gammas_f_v)
+        for j in range(len(gammas_f_u)):
+            grad_gammas[f_inds_u[i, j]] += w / 4 * sin_u * sin_v * cos_prod_d * cos_prod_e * (cos_prod_derivs_f_plus[j] - cos_prod_derivs_f_minus[j]) + \
+                w / 2 * sin_uv * sin_u * cos_v * cos_prod_d * cos_prod_derivs_f_u[j]
+            grad_gammas[f_inds_v[i, j]] += w / 4 * sin_u * sin_v * cos_prod_d * cos_prod_e * (cos_prod_derivs_f_plus[j] + cos_prod_derivs_f_minus[j]) + \
+                w / 2 * sin_uv * cos_u * sin_v * cos_prod_e * cos_prod_derivs_f_v[j]
+
+    return np.concatenate((grad_gammas[:num_edges] * edge_weights, grad_betas))
+
+
+def calc_expectation_ma_qaoa_analytical_p1(angles: ndarray, topology: TopologyP1) -> float:
     """
     Calculates target expectation for given angles with MA-QAOA ansatz via an analytical formula for p=1.
     The formula is taken from Vijendran, V., Das, A., Koh, D. E., Assad, S. M. & Lam, P. K. An Expressive Ansatz for Low-Depth Quantum Optimisation. (2023)
     :param angles: 1D array of all angles for the first layer. Same format as in run_ma_qaoa_simulation.
-    :param graph: Graph for which MaxCut problem is being solved.
-    :param edge_list: List of edges that should be taken into account when calculating expectation value. If None, then all edges are taken into account.
+    :param topology: Topology of the graph for which MaxCut problem is being solved (see `TopologyP1.create`).
     :return: Expectation value of C (sum of all Cuv) in the state corresponding to the given set of angles, i.e. <beta, gamma|C|beta, gamma>.
     """
-    if edge_list is None:
-        edge_list = graph.edges
+    return calc_expectation_ma_qaoa_analytical_p1_arrays(angles, topology.edge_weights, topology.edges, topology.edge_inds, topology.d_inds, topology.e_inds,
+                                                         topology.f_inds_u, topology.f_inds_v)
 
-    gammas = angles[0:len(graph.edges)]
-    betas = angles[len(graph.edges):]
-    nx.set_edge_attributes(graph, {(u, v): gammas[i] * w for i, (u, v, w) in enumerate(graph.edges.data('weight'))}, name='gamma')
-    objective = 0
-    for u, v in edge_list:
-        w = graph.edges[(u, v)]['weight']
-        cuv = w / 2
-        d = set(graph[u]) - {v}
-        e = set(graph[v]) - {u}
-        f = d & e
-        cos_prod_d = math.prod([cos(graph.edges[u, m]['gamma']) for m in d - f])
-        cos_prod_e = math.prod([cos(graph.edges[v, m]['gamma']) for m in e - f])
 
-        # Triangle terms
-        if len(f) != 0:
-            cos_prod_f_plus = math.prod([cos(graph.edges[u, m]['gamma'] + graph.edges[v, m]['gamma']) for m in f])
-            cos_prod_f_minus = math.prod([cos(graph.edges[u, m]['gamma'] - graph.edges[v, m]['gamma']) for m in f])
-            cuv += w / 4 * sin(2 * betas[u]) * sin(2 * betas[v]) * cos_prod_d * cos_prod_e * (cos_prod_f_plus - cos_prod_f_minus)
-            cos_prod_d *= math.prod([cos(graph.edges[u, m]['gamma']) for m in f])
-            cos_prod_e *= math.prod([cos(graph.edges[v, m]['gamma']) for m in f])
+def calc_gradient_ma_qaoa_analytical_p1(angles: ndarray, topology: TopologyP1) -> ndarray:
+    """
+    Calculates gradient of `calc_expectation_ma_qaoa_analytical_p1` with respect to the angles.
+    :param angles: 1D array of all angles for the first layer. Same format as in `calc_expectation_ma_qaoa_analytical_p1`.
+    :param topology: Topology of the graph for which MaxCut problem is being solved (see `TopologyP1.create`).
+    :return: 1D array of partial derivatives of the expectation value with respect to each angle.
+    """
+    return calc_gradient_ma_qaoa_analytical_p1_arrays(angles, topology.edge_weights, topology.edges, topology.edge_inds, topology.d_inds, topology.e_inds,
+                                                      topology.f_inds_u, topology.f_inds_v)
 
-        cuv += w / 2 * sin(graph.edges[u, v]['gamma']) * \
-            (sin(2 * betas[u]) * cos(2 * betas[v]) * cos_prod_d + cos(2 * betas[u]) * sin(2 * betas[v]) * cos_prod_e)
-        objective += cuv
 
-    return objective
+def calc_expectation_qaoa_analytical_p1_grid(gammas: ndarray, betas: ndarray, topology: TopologyP1) -> ndarray:
+    """
+    Calculates target expectation with standard QAOA ansatz (same angle for all edges and same angle for all nodes) via an analytical formula for p=1
+    for all combinations of the given angles at once. Useful to plot expectation landscape without calling the evaluator for each grid point.
+    :param gammas: 1D array of edge angles.
+    :param betas: 1D array of node angles.
+    :param topology: Topology of the graph for which MaxCut problem is being solved (see `TopologyP1.create`).
+    :return: 2D array of size len(gammas) x len(betas) with expectation values for each combination of angles.
+    """
+    gamma_col = np.asarray(gammas)[:, np.newaxis]
+    sin_beta = sin(2 * np.asarray(betas))[np.newaxis, :]
+    cos_beta = cos(2 * np.asarray(betas))[np.newaxis, :]
+    weights = np.append(topology.edge_weights, 0)
+    cos_gammas = cos(gamma_col * weights)
 
+    expectation = np.zeros((len(gamma_col), sin_beta.shape[1]))
+    for i, edge_ind in enumerate(topology.edge_inds):
+        w = weights[edge_ind]
+        cos_prod_d = np.prod(cos_gammas[:, topology.d_inds[i]], axis=1, keepdims=True)
+        cos_prod_e = np.prod(cos_gammas[:, topology.e_inds[i]], axis=1, keepdims=True)
 
-def calc_expectation_random_qaoa_analytical_p1(angles: ndarray, graph: Graph, graph_random: Graph, edge_list: list[tuple[int, int]] = None) -> float:
+        # Triangle terms
+        weights_f_u = weights[topology.f_inds_u[i]]
+        weights_f_v = weights[topology.f_inds_v[i]]
+        cos_prod_f_plus = np.prod(cos(gamma_col * (weights_f_u + weights_f_v)), axis=1, keepdims=True)
+        cos_prod_f_minus = np.prod(cos(gamma_col * (weights_f_u - weights_f_v)), axis=1, keepdims=True)
+        expectation += w / 2 + w / 4 * sin_beta ** 2 * cos_prod_d * cos_prod_e * (cos_prod_f_plus - cos_prod_f_minus)
+        cos_prod_d *= np.prod(cos_gammas[:, topology.f_inds_u[i]], axis=1, keepdims=True)
+        cos_prod_e *= np.prod(cos_gammas[:, topology.f_inds_v[i]], axis=1, keepdims=True)
+
+        expectation += w / 2 * sin(gamma_col * w) * sin_beta * cos_beta * (cos_prod_d + cos_prod_e)
+    return expectation
+
+
+def get_neighbour_counts_random_p1(graph: Graph, graph_random: Graph, edge_list: list[tuple[int, int]] = None) -> ndarray:
     """
-    Calculates target expectation for given angles with Random Circuit QAOA ansatz via an analytical formula for p=1.
-    :param angles: 1D array of all angles for the first layer. Same format as in run_ma_qaoa_simulation.
+    Counts neighbours in the circuit graph required by the analytical formula for Random Circuit QAOA expectation at p=1. With the same angle for all edges,
+    the formula depends on these counts only, so they can be calculated once per pair of graphs.
     :param graph: Graph for which MaxCut problem is being solved.
     :param graph_random: Graph used in circuit for which MaxCut problem is being solved.
     :param edge_list: List of edges that should be taken into account when calculating expectation value. If None, then all edges are taken into account.
-    :return: Expectation value of C (sum of all Cuv) in the state corresponding to the given set of angles, i.e. <beta, gamma|C|beta, gamma>.
+    :return: 2D array of size len(edge_list) x 4. Columns for each edge (u, v): number of neighbours of u, but not of v; number of neighbours of v, but not of u;
+    number of common neighbours of u and v; 1 if (u, v) is an edge of graph_random, 0 otherwise.
     """
     if edge_list is None:
         edge_list = graph.edges
 
+    counts = []
+    for u, v in edge_list:
+        d = set(graph_random[u]) - {v}
+        e = set(graph_random[v]) - {u}
+        f = d & e
+        counts.append([len(d - f), len(e - f), len(f), int(u in graph_random[v])])
+    return np.array(counts, dtype=int).reshape((-1, 4))
+
+
+def calc_expectation_random_qaoa_analytical_p1(angles: ndarray, neighbour_counts: ndarray) -> float:
+    """
+    Calculates target expectation for given angles with Random Circuit QAOA ansatz via an analytical formula for p=1.
+    :param angles: 1D array of all angles for the first layer. Same format as in run_ma_qaoa_simulation.
+    :param neighbour_counts: Neighbour counts in the circuit graph for each considered edge (see `get_neighbour_counts_random_p1`).
+    :return: Expectation value of C (sum of all Cuv) in the state corresponding to the given set of angles, i.e. <beta, gamma|C|beta, gamma>.
+    """
     gammas = angles[0]
     betas = angles[1]
     # nx.set_edge_attributes(graph_random, {(u, v): gammas[i] * w for i, (u, v, w) in enumerate(graph_random.edges.data('weight'))}, name='gamma')
@@ -118,26 +367,14 @@ def calc_expectation_random_qaoa_analytical_p1(angles: ndarray, graph: Graph, gr
 
     # nx.set_edge_attributes(graph_random, {(u, v): gammas[i] for i, (u, v) in enumerate(graph_random.edges)}, name='gamma')
 
-    for u, v in edge_list:
-        cuv = 1 / 2
-        d = set(graph_random[u]) - {v}
-        e = set(graph_random[v]) - {u}
-        f = d & e
+    num_d, num_e, num_f, chi = neighbour_counts.T
+    cos_prod_d = cos(gammas) ** num_d
+    cos_prod_e = cos(gammas) ** num_e
 
-        cos_prod_d = math.prod([cos(gammas) for m in d - f])
-        cos_prod_e = math.prod([cos(gammas) for m in e - f])
+    # Triangle terms
+    cuv = 1 / 2 + 1 / 4 * sin(2 * betas) * sin(2 * betas) * cos_prod_d * cos_prod_e * (cos(gammas + gammas) ** num_f - cos(gammas - gammas) ** num_f)
+    cos_prod_d *= cos(gammas) ** num_f
+    cos_prod_e *= cos(gammas) ** num_f
 
-        # Triangle terms
-        if len(f) != 0:
-            cos_prod_f_plus = math.prod([cos(gammas + gammas) for m in f])
-            cos_prod_f_minus = math.prod([cos(gammas - gammas) for m in f])
-            cuv += 1 / 4 * sin(2 * betas) * sin(2 * betas) * cos_prod_d * cos_prod_e * (cos_prod_f_plus - cos_prod_f_minus)
-            cos_prod_d *= math.prod([cos(gammas) for m in f])
-            cos_prod_e *= math.prod([cos(gammas) for m in f])
-
-        if u in graph_random[v]:
-            cuv += 1 * 1 / 2 * sin(gammas) * \
-                (sin(2 * betas) * cos(2 * betas) * cos_prod_d + cos(2 * betas) * sin(2 * betas) * cos_prod_e)
-
-        objective += cuv
-    return objective
+    cuv += chi * 1 / 2 * sin(gammas) * (sin(2 * betas) * cos(2 * betas) * cos_prod_d + cos(2 * betas) * sin(2 * betas) * cos_prod_e)
+    return np.sum(cuv)
@@ -31,27 +31,57 @@ def convert_angles_qaoa_to_ma(angles: ndarray, num_edges: int, num_nodes: int) -
     :param num_nodes: Number of nodes in the graph.
     :return: angles in MA-QAOA format (individual angle for each node and edge of the graph in each layer).
     """
-    maqaoa_angles = []
-    for gamma, beta in zip(angles[::2], angles[1::2]):
-        maqaoa_angles += [gamma] * num_edges
-        maqaoa_angles += [beta] * num_nodes
-    return np.array(maqaoa_angles)
+    angle_layers = np.reshape(angles, (-1, 2))
+    return np.concatenate((np.repeat(angle_layers[:, :1], num_edges, axis=1), np.repeat(angle_layers[:, 1:], num_nodes, axis=1)), axis=1).ravel()
 
 
-def qaoa_decorator(ma_qaoa_func: callable, num_edges: int, num_nodes: int) -> callable:
+def get_qaoa_to_ma_indices(num_edges: int, num_nodes: int, p: int) -> ndarray:
+    """
+    Returns indices that convert QAOA angles to MA-QAOA format by indexing, i.e. convert_angles_qaoa_to_ma(angles) == angles[inds].
+    :param num_edges: Number of edges in the graph.
+    :param num_nodes: Number of nodes in the graph.
+    :param p: Number of QAOA layers.
+    :return: 1D array of size (num_edges + num_nodes) * p with index of QAOA angle for each MA-QAOA angle.
+    """
+    return np.repeat(np.arange(2 * p), [num_edges, num_nodes] * p)
+
+
+def qaoa_decorator(ma_qaoa_func: callable, num_edges: int, num_nodes: int, p: int) -> callable:
     """
     Duplicates standard QAOA angles to match MA-QAOA format and calls the provided MA-QAOA function.
     :param ma_qaoa_func: Function that expects MA-QAOA angles as first parameter.
     :param num_edges: Number of edges in the graph.
     :param num_nodes: Number of nodes in the graph.
-    :return: Adapted function that accepts angles in QAOA format.
+    :param p: Number of QAOA layers.
+    :return: Adapted function that accepts angles in QAOA format. Raises an exception if the number of angles does not match p.
     """
+    inds = get_qaoa_to_ma_indices(num_edges, num_nodes, p)
+
     def qaoa_wrapped(*args, **kwargs):
-        angles_maqaoa = convert_angles_qaoa_to_ma(args[0], num_edges, num_nodes)
-        return ma_qaoa_func(angles_maqaoa, *args[1:], **kwargs)
+        if len(args[0]) != 2 * p:
+            raise Exception(f'Expected {2 * p} QAOA angles, got {len(args[0])}')
+        return ma_qaoa_func(args[0][inds], *args[1:], **kwargs)
     return qaoa_wrapped
 
 
+def qaoa_gradient_decorator(ma_qaoa_grad: callable, num_edges: int, num_nodes: int, p: int) -> callable:
+    """
+    Gradient counterpart of `qaoa_decorator`, i.e. sums partial derivatives over all repeats of each QAOA angle.
+    :param ma_qaoa_grad: Function that expects MA-QAOA angles as first parameter and returns gradient in MA-QAOA format.
+    :param num_edges: Number of edges in the graph.
+    :param num_nodes: Number of nodes in the graph.
+    :param p: Number of QAOA layers.
+    :return: Adapted function that accepts angles in QAOA format and returns gradient in QAOA format. Raises an exception if the number of angles does not match p.
+    """
+    inds = get_qaoa_to_ma_indices(num_edges, num_nodes, p)
+
+    def qaoa_grad_wrapped(*args, **kwargs):
+        if len(args[0]) != 2 * p:
+            raise Exception(f'Expected {2 * p} QAOA angles, got {len(args[0])}')
+        return np.bincount(inds, ma_qaoa_grad(args[0][inds], *args[1:], **kwargs), 2 * p)
+    return qaoa_grad_wrapped
+
+
 def convert_angles_fourier_to_qaoa(fourier_angles: ndarray) -> ndarray:
     """
     Converts QAOA angles from the fourier to qaoa search space.
@@ -196,6 +226,24 @@ def fix_angles(eval_func: callable, num_angles: int, inds: list[int], values: li
     return new_func
 
 
+def fix_angles_gradient(grad_func: callable, num_angles: int, inds: list[int], values: list[float]) -> callable:
+    """
+    Gradient counterpart of `fix_angles`.
+    :param grad_func: Original gradient function that accepts ndarray of angles.
+    :param num_angles: Size of array expected by the original gradient function.
+    :param inds: Indices of elements that are to be fixed.
+    :param values: Values for the fixed elements.
+    :return: New gradient function that expects smaller input array and returns the derivatives with respect to the remaining (not fixed) elements only.
+    """
+    full_grad_func = fix_angles(grad_func, num_angles, inds, values)
+
+    def new_grad_func(angles: ndarray):
+        mask = np.ones(num_angles, dtype=bool)
+        mask[inds] = False
+        return full_grad_func(angles)[mask]
+    return new_grad_func
+
+
 # def qaoa_scheme_decorator(ma_qaoa_func: callable, duplication_scheme: list[ndarray]) -> callable:
 #     """ Test decorator that uses custom duplication schemes. """
 #     def qaoa_wrapped(*args, **kwargs):
@@ -1,6 +1,10 @@
 """
 Graph utilities.
 """
+from __future__ import annotations
+
+import hashlib
+from dataclasses import dataclass, field
 from queue import SimpleQueue
 from typing import Sequence
 
@@ -10,6 +14,36 @@ from networkx import Graph
 from numpy import ndarray
 
 
+@dataclass(frozen=True)
+class GraphKey:
+    """
+    Hashable reference to a graph that compares graphs by their nodes and weighted edges, so that functions of graphs can be cached with lru_cache.
+    :var nodes: Tuple of nodes in the order of graph.nodes.
+    :var edges: Tuple of (u, v, weight) in the order of graph.edges.
+    :var graph: Referenced graph. Not compared.
+    """
+    nodes: tuple
+    edges: tuple
+    graph: Graph = field(compare=False)
+
+    @staticmethod
+    def create(graph: Graph) -> GraphKey:
+        """
+        Creates an instance of GraphKey.
+        :param graph: Graph to reference.
+        :return: Instance of GraphKey class.
+        """
+        return GraphKey(tuple(graph.nodes), tuple(graph.edges.data('weight')), graph)
+
+    def digest(self) -> str:
+        """
+        Returns a hash of nodes and weighted edges that is stable between runs (unlike hash), so it can be used to name files.
+        Isomorphic graphs with different labeling have different digests since per-node and per-edge angles depend on the labeling.
+        :return: Hex digest.
+        """
+        return hashlib.sha256(repr((self.nodes, self.edges)).encode()).hexdigest()
+
+
 def edge_bfs(graph: Graph, starting_edge: tuple) -> dict[tuple, int]:
     """
     Carries out edge BFS from the specified edge and returns distances to all other edges.
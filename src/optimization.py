@@ -3,11 +3,18 @@ Functions related to optimization of QAOA angles.
 """
 from __future__ import annotations
 
+import hashlib
 import logging
+import multiprocessing
+import os
+import pickle
 import time
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 from typing import Callable
 
+import numba
 import numpy as np
 import numpy.random as random
 from scipy import optimize
@@ -15,12 +22,15 @@ from networkx import Graph
 from numpy import ndarray
 from scipy.optimize import OptimizeResult
 
-from src.analytical import calc_expectation_ma_qaoa_analytical_p1, calc_expectation_random_qaoa_analytical_p1
-from src.angle_strategies import qaoa_decorator, linear_decorator, tqa_decorator, fix_angles, fourier_decorator
+from src.analytical import TopologyP1, calc_expectation_general_analytical_z1_arrays, calc_expectation_general_analytical_z1_reduced_arrays, \
+    calc_expectation_ma_qaoa_analytical_p1, calc_expectation_random_qaoa_analytical_p1, calc_gradient_ma_qaoa_analytical_p1, \
+    get_neighbour_counts_random_p1
+from src.angle_strategies import get_qaoa_to_ma_indices, qaoa_decorator, linear_decorator, tqa_decorator, fix_angles, fourier_decorator, qaoa_gradient_decorator, fix_angles_gradient
 from src.data_processing import normalize_qaoa_angles
-from src.graph_utils import get_index_edge_list
-from src.preprocessing import PSubset, evaluate_graph_cut, evaluate_z_term
-from src.simulation.plain import calc_expectation_general_qaoa, calc_expectation_general_qaoa_subsets
+from src.graph_utils import GraphKey, get_index_edge_list
+from src.preprocessing import PSubset, evaluate_graph_cut, get_z_term_masks
+from src.simulation.plain import calc_expectation_general_qaoa, calc_expectation_general_qaoa_masks, calc_expectation_general_qaoa_subsets, calc_gradient_general_qaoa, \
+    calc_gradient_general_qaoa_masks, calc_expectation_general_qaoa_batched, calc_expectation_general_qaoa_batched_masks
 
 # from qiskit_aer.primitives import Estimator as AerEstimator
 # from qiskit.primitives import Estimator
@@ -28,18 +38,113 @@ from src.simulation.plain import calc_expectation_general_qaoa, calc_expectation
 # from src.simulation.qiskit_backend import evaluate_angles_ma_qiskit, get_observable_maxcut, get_ma_ansatz, evaluate_angles_ma_qiskit_fast
 
 
+# Number of graphs whose preprocessed data is kept by the caches below. Entries include arrays of size 2 ** n, so the caches are kept small.
+GRAPH_CACHE_SIZE = 4
+
+
+def get_edge_list_key(edge_list: list[tuple[int, int]] | None) -> tuple | None:
+    """
+    Converts edge list to a hashable form that can be passed to the cached functions below.
+    :param edge_list: List of edges or None.
+    :return: Tuple of edge tuples or None.
+    """
+    return None if edge_list is None else tuple(tuple(edge) for edge in edge_list)
+
+
+@lru_cache(maxsize=GRAPH_CACHE_SIZE)
+def get_maxcut_target_vals(graph_key: GraphKey, edge_list: tuple | None) -> ndarray:
+    """
+    Cached version of `evaluate_graph_cut`. The returned array is shared between calls, so it is read-only.
+    :param graph_key: Key of the graph for evaluation.
+    :param edge_list: Tuple of edges that should be taken into account (see `get_edge_list_key`). If None, then all edges are taken into account.
+    :return: 1D array of size 2 ** num_qubits with the cut values for each computational basis.
+    """
+    target_vals = evaluate_graph_cut(graph_key.graph, edge_list)
+    target_vals.flags.writeable = False
+    return target_vals
+
+
+@lru_cache(maxsize=GRAPH_CACHE_SIZE)
+def get_maxcut_driver_term_masks(graph_key: GraphKey) -> ndarray:
+    """
+    Returns cached read-only bitmasks of the edge terms of a given graph (see `get_z_term_masks`).
+    :param graph_key: Key of the graph.
+    :return: 1D array of bitmasks in the order of graph.edges.
+    """
+    driver_term_masks = get_z_term_masks(get_index_edge_list(graph_key.graph), len(graph_key.graph))
+    driver_term_masks.flags.writeable = False
+    return driver_term_masks
+
+
+@lru_cache(maxsize=GRAPH_CACHE_SIZE)
+def get_p_subsets(num_qubits: int, target_terms: tuple[frozenset[int], ...], driver_terms: tuple[frozenset[int], ...], p: int) -> list[PSubset]:
+    """
+    Returns cached p-subsets induced by each target term (see `PSubset.create`).
+    :param num_qubits: Total number of qubits in the problem.
+    :param target_terms: Indices of qubits of each term in Z-expansion of the target function.
+    :param driver_terms: Indices of qubits of each term in Z-expansion of the driver function.
+    :param p: Number of QAOA layers.
+    :return: List of p-subsets in the order of target terms.
+    """
+    return [PSubset.create(num_qubits, inducing_term, list(driver_terms), p) for inducing_term in target_terms]
+
+
+@lru_cache(maxsize=GRAPH_CACHE_SIZE)
+def get_topology_p1(graph_key: GraphKey, edge_list: tuple | None) -> TopologyP1:
+    """
+    Cached version of `TopologyP1.create`.
+    :param graph_key: Key of the graph for which MaxCut problem is being solved.
+    :param edge_list: Tuple of edges that should be taken into account (see `get_edge_list_key`). If None, then all edges are taken into account.
+    :return: Instance of TopologyP1 class.
+    """
+    return TopologyP1.create(graph_key.graph, edge_list)
+
+
 @dataclass
 class Evaluator:
     """
     Class representing evaluator for target function expectation.
     :var func: Function that takes 1D array of input parameters and evaluates target expectation.
     :var num_angles: Number of elements in the 1D array expected by func.
+    :var grad: Function that takes 1D array of input parameters and evaluates gradient of func, or None if gradient is not available.
+    :var func_batch: Function that takes 2D array with a set of input parameters in each row and evaluates func for all of them at once, or None if not available.
+    :var num_qubits: Number of qubits in the evaluated problem (number of nodes for MaxCut), or None if unknown.
     """
     func: Callable[[ndarray], float]
     num_angles: int
+    grad: Callable[[ndarray], ndarray] | None = None
+    func_batch: Callable[[ndarray], ndarray] | None = None
+    num_qubits: int | None = None
+
+    def __post_init__(self):
+        self.func = cache_last_values(self.func)
+        if self.grad is not None:
+            self.grad = cache_last_values(self.grad)
+
+    @staticmethod
+    def get_num_angles(num_qubits: int, num_driver_terms: int, p: int, search_space: str = 'ma') -> int:
+        """
+        Returns number of angles expected by the evaluators returned from `wrap_parameter_strategy`.
+        :param num_qubits: Number of qubits.
+        :param num_driver_terms: Number of terms in the driver function.
+        :param p: Number of QAOA layers.
+        :param search_space: Name of the strategy to choose the number of variable parameters.
+        :return: Number of angles.
+        """
+        if search_space == 'general' or search_space == 'ma' or search_space == 'xqaoa':
+            return (num_driver_terms + num_qubits) * p
+        elif search_space == 'qaoa' or search_space == 'fourier':
+            return 2 * p
+        elif search_space == 'linear':
+            return 4
+        elif search_space == 'tqa':
+            return 1
+        else:
+            raise Exception('Unknown search space')
 
     @staticmethod
-    def wrap_parameter_strategy(ma_qaoa_func: callable, num_qubits: int, num_driver_terms: int, p: int, search_space: str = 'ma') -> Evaluator:
+    def wrap_parameter_strategy(ma_qaoa_func: callable, num_qubits: int, num_driver_terms: int, p: int, search_space: str = 'ma', ma_qaoa_grad: callable = None,
+                                ma_qaoa_func_batch: callable = None) -> Evaluator:
         """
         Wraps MA-QAOA function input according to the specified angle strategy.
         :param ma_qaoa_func: MA-QAOA function of angles only to be maximized.
@@ -47,55 +152,91 @@ class Evaluator:
         :param num_driver_terms: Number of terms in the driver function.
         :param p: Number of QAOA layers.
         :param search_space: Name of the strategy to choose the number of variable parameters.
+        :param ma_qaoa_grad: Gradient of ma_qaoa_func or None if not available. Only kept for the search spaces where it can be converted to the chosen angle strategy.
+        :param ma_qaoa_func_batch: Batched version of ma_qaoa_func or None if not available. Only kept for the search spaces where input can be converted by indexing.
         :return: Simulation evaluator. The order of input parameters is according to the angle strategy.
         """
+        num_angles = Evaluator.get_num_angles(num_qubits, num_driver_terms, p, search_space)
+        grad = None
+        func_batch = None
         if search_space == 'general' or search_space == 'ma' or search_space == 'xqaoa':
-            num_angles = (num_driver_terms + num_qubits) * p
+            grad = ma_qaoa_grad
+            func_batch = ma_qaoa_func_batch
         elif search_space == 'qaoa' or search_space == 'fourier':
-            num_angles = 2 * p
-            ma_qaoa_func = qaoa_decorator(ma_qaoa_func, num_driver_terms, num_qubits)
+            ma_qaoa_func = qaoa_decorator(ma_qaoa_func, num_driver_terms, num_qubits, p)
             if search_space == 'fourier':
                 ma_qaoa_func = fourier_decorator(ma_qaoa_func)
+            else:
+                if ma_qaoa_grad is not None:
+                    grad = qaoa_gradient_decorator(ma_qaoa_grad, num_driver_terms, num_qubits, p)
+                if ma_qaoa_func_batch is not None:
+                    inds = get_qaoa_to_ma_indices(num_driver_terms, num_qubits, p)
+                    func_batch = lambda angles_batch: ma_qaoa_func_batch(angles_batch[:, inds])
         elif search_space == 'linear':
-            num_angles = 4
-            ma_qaoa_func = linear_decorator(qaoa_decorator(ma_qaoa_func, num_driver_terms, num_qubits), p)
+            ma_qaoa_func = linear_decorator(qaoa_decorator(ma_qaoa_func, num_driver_terms, num_qubits, p), p)
         elif search_space == 'tqa':
-            num_angles = 1
-            ma_qaoa_func = tqa_decorator(qaoa_decorator(ma_qaoa_func, num_driver_terms, num_qubits), p)
+            ma_qaoa_func = tqa_decorator(qaoa_decorator(ma_qaoa_func, num_driver_terms, num_qubits, p), p)
         else:
             raise 'Unknown search space'
-        return Evaluator(change_sign(ma_qaoa_func), num_angles)
+        return Evaluator(change_sign(ma_qaoa_func), num_angles, None if grad is None else change_sign(grad), None if func_batch is None else change_sign(func_batch),
+                         num_qubits)
 
     @staticmethod
-    def get_evaluator_general(target_vals: ndarray, driver_term_vals: ndarray, p: int, search_space: str = 'ma') -> Evaluator:
+    def get_evaluator_general(target_vals: ndarray, driver_term_vals: ndarray, p: int, search_space: str = 'ma', dtype: type = np.complex128) -> Evaluator:
         """
         Returns evaluator of target expectation calculated through simulation.
         :param target_vals: Values of the target function at each computational basis.
         :param driver_term_vals: 2D array of size #terms x 2 ** #qubits. Each row is an array of values of a driver function's term for each computational basis.
+        Tables of +-1 values are stored as int8 (as returned by `evaluate_z_terms_batch`), since the simulation streams through them every layer.
         :param p: Number of QAOA layers.
         :param search_space: Name of the strategy to choose the number of variable parameters.
+        :param dtype: Complex data type of the simulated state vector. np.complex64 halves memory traffic at the cost of precision.
         :return: Simulation evaluator. The order of input parameters: first, driver term angles for 1st layer in the same order as rows of driver_term_vals,
         then mixer angles for 1st layer in the qubits order, then the same format repeats for other layers.
         """
+        if driver_term_vals.dtype != np.int8 and np.all(np.abs(driver_term_vals) == 1):
+            driver_term_vals = driver_term_vals.astype(np.int8)
         apply_y = search_space == 'xqaoa'
-        func = lambda angles: calc_expectation_general_qaoa(angles, driver_term_vals, p, target_vals, apply_y)
+        func = partial(calc_expectation_general_qaoa, driver_term_vals=driver_term_vals, p=p, target_vals=target_vals, apply_y=apply_y, dtype=dtype)
+        grad = None if apply_y else partial(calc_gradient_general_qaoa, driver_term_vals=driver_term_vals, p=p, target_vals=target_vals, dtype=dtype)
+        func_batch = partial(calc_expectation_general_qaoa_batched, driver_term_vals=driver_term_vals, p=p, target_vals=target_vals, apply_y=apply_y, dtype=dtype)
         num_qubits = len(target_vals).bit_length() - 1
-        return Evaluator.wrap_parameter_strategy(func, num_qubits, driver_term_vals.shape[0], p, search_space)
+        return Evaluator.wrap_parameter_strategy(func, num_qubits, driver_term_vals.shape[0], p, search_space, grad, func_batch)
 
     @staticmethod
-    def get_evaluator_standard_maxcut(graph: Graph, p: int, edge_list: list[tuple[int, int]] = None, search_space: str = 'ma') -> Evaluator:
+    def get_evaluator_general_masks(target_vals: ndarray, driver_term_masks: ndarray, p: int, search_space: str = 'ma', dtype: type = np.complex128) -> Evaluator:
+        """
+        Same as `get_evaluator_general`, but the driver terms are given as bitmasks (see `get_z_term_masks`), so their values are not stored for each computational basis.
+        :param target_vals: Values of the target function at each computational basis.
+        :param driver_term_masks: 1D array of bitmasks of qubits in each term in Z-expansion of the driver function.
+        :param p: Number of QAOA layers.
+        :param search_space: Name of the strategy to choose the number of variable parameters.
+        :param dtype: Complex data type of the simulated state vector. np.complex64 halves memory traffic at the cost of precision.
+        :return: Simulation evaluator. The order of input parameters is the same as in `get_evaluator_general`.
+        """
+        apply_y = search_space == 'xqaoa'
+        func = partial(calc_expectation_general_qaoa_masks, driver_term_masks=driver_term_masks, p=p, target_vals=target_vals, apply_y=apply_y, dtype=dtype)
+        grad = None if apply_y else partial(calc_gradient_general_qaoa_masks, driver_term_masks=driver_term_masks, p=p, target_vals=target_vals, dtype=dtype)
+        func_batch = partial(calc_expectation_general_qaoa_batched_masks, driver_term_masks=driver_term_masks, p=p, target_vals=target_vals, apply_y=apply_y, dtype=dtype)
+        num_qubits = len(target_vals).bit_length() - 1
+        return Evaluator.wrap_parameter_strategy(func, num_qubits, len(driver_term_masks), p, search_space, grad, func_batch)
+
+    @staticmethod
+    def get_evaluator_standard_maxcut(graph: Graph, p: int, edge_list: list[tuple[int, int]] = None, search_space: str = 'ma', dtype: type = np.complex128) -> Evaluator:
         """
         Returns an instance of general evaluator where the target function is the cut function and the driver function includes the existing edge terms only.
         :param graph: Graph for MaxCut problem.
         :param p: Number of QAOA layers.
         :param edge_list: List of edges that should be taken into account when calculating expectation value. If None, then all edges are taken into account.
         :param search_space: Name of the strategy to choose the number of variable parameters.
+        :param dtype: Complex data type of the simulated state vector. np.complex64 halves memory traffic at the cost of precision.
         :return: Simulation evaluator. The order of input parameters: first, edge angles for 1st layer in the order of graph.edges, then node angles for the 1st layer in the order
         of graph.nodes. Then the format repeats for the remaining p - 1 layers.
         """
-        target_vals = evaluate_graph_cut(graph, edge_list)
-        driver_term_vals = np.array([evaluate_z_term(edge, len(graph)) for edge in get_index_edge_list(graph)])
-        return Evaluator.get_evaluator_general(target_vals, driver_term_vals, p, search_space)
+        graph_key = GraphKey.create(graph)
+        target_vals = get_maxcut_target_vals(graph_key, get_edge_list_key(edge_list))
+        driver_term_masks = get_maxcut_driver_term_masks(graph_key)
+        return Evaluator.get_evaluator_general_masks(target_vals, driver_term_masks, p, search_space, dtype)
 
     @staticmethod
     def get_evaluator_general_subsets(num_qubits: int, target_terms: list[set[int]], target_coeffs: list[float], driver_terms: list[set[int]], p: int,
@@ -110,8 +251,8 @@ class Evaluator:
         :param search_space: Name of the strategy to choose the number of variable parameters.
         :return: Evaluator that accepts 1D array of angles and returns the corresponding target expectation value. The order of angles is the same as in `get_evaluator_general`.
         """
-        subsets = [PSubset.create(num_qubits, inducing_term, driver_terms, p) for inducing_term in target_terms]
-        func = lambda angles: calc_expectation_general_qaoa_subsets(angles, subsets, target_coeffs, p)
+        subsets = get_p_subsets(num_qubits, tuple(frozenset(term) for term in target_terms), tuple(frozenset(term) for term in driver_terms), p)
+        func = partial(calc_expectation_general_qaoa_subsets, subsets=subsets, subset_coeffs=target_coeffs, p=p)
         return Evaluator.wrap_parameter_strategy(func, num_qubits, len(driver_terms), p, search_space)
 
     @staticmethod
@@ -123,11 +264,31 @@ class Evaluator:
         :param edge_list: List of edges that should be taken into account when calculating expectation value. If None, then all edges are taken into account.
         :param search_space: Name of the strategy to choose the number of variable parameters.
         :return: Simulation subgraph evaluator. The order of input parameters is the same as in `get_evaluator_standard_maxcut`.
+        The subsets are constructed on the first evaluation (see `LazyEvaluator`).
         """
         target_terms = [set(edge) for edge in get_index_edge_list(graph, edge_list)]
         target_term_coeffs = [-1 / 2] * len(target_terms) + [len(target_terms) / 2]
         driver_terms = [set(edge) for edge in get_index_edge_list(graph)]
-        return Evaluator.get_evaluator_general_subsets(len(graph), target_terms, target_term_coeffs, driver_terms, p, search_space)
+        build = partial(Evaluator.get_evaluator_general_subsets, len(graph), target_terms, target_term_coeffs, driver_terms, p, search_space)
+        num_angles = Evaluator.get_num_angles(len(graph), len(driver_terms), p, search_space)
+        return LazyEvaluator(None, num_angles, num_qubits=len(graph), build=build)
+
+    @staticmethod
+    def get_evaluator_general_z1_analytical(graph: Graph, reduced: bool = False) -> Evaluator:
+        """
+        Returns analytical evaluator of MaxCut expectation for p=1 with Generalized first-order QAOA ansatz.
+        :param graph: Target graph for MaxCut.
+        :param reduced: True to fix all angles of the first half and vary the rest only (see `calc_expectation_general_analytical_z1_reduced`).
+        :return: Analytical evaluator. The order of input parameters is the same as in `calc_expectation_general_analytical_z1(_reduced)`.
+        """
+        index_edges = get_index_edge_list(graph)
+        if reduced:
+            func = partial(calc_expectation_general_analytical_z1_reduced_arrays, index_edges=index_edges, num_nodes=len(graph))
+            num_angles = len(graph)
+        else:
+            func = partial(calc_expectation_general_analytical_z1_arrays, index_edges=index_edges, num_nodes=len(graph))
+            num_angles = 2 * len(graph)
+        return Evaluator(change_sign(func), num_angles, num_qubits=len(graph))
 
     @staticmethod
     def get_evaluator_standard_maxcut_analytical(graph: Graph, edge_list: list[tuple[int, int]] = None, use_multi_angle: bool = True) -> Evaluator:
@@ -139,13 +300,16 @@ class Evaluator:
         :return: Analytical evaluator. The input parameters are specified in the following order: all edge angles in the order of graph.edges, then all node angles
         in the order of graph.nodes.
         """
-        func = lambda angles: calc_expectation_ma_qaoa_analytical_p1(angles, graph, edge_list)
+        topology = get_topology_p1(GraphKey.create(graph), get_edge_list_key(edge_list))
+        func = partial(calc_expectation_ma_qaoa_analytical_p1, topology=topology)
+        grad = partial(calc_gradient_ma_qaoa_analytical_p1, topology=topology)
         if use_multi_angle:
             num_angles = len(graph.edges) + len(graph)
         else:
-            func = qaoa_decorator(func, len(graph.edges), len(graph))
+            func = qaoa_decorator(func, len(graph.edges), len(graph), 1)
+            grad = qaoa_gradient_decorator(grad, len(graph.edges), len(graph), 1)
             num_angles = 2
-        return Evaluator(change_sign(func), num_angles)
+        return Evaluator(change_sign(func), num_angles, change_sign(grad), num_qubits=len(graph))
 
     @staticmethod
     def get_evaluator_random_circuit_maxcut_analytical(graph: Graph, random_graph: Graph, edge_list: list[tuple[int, int]] = None) -> Evaluator:
@@ -157,9 +321,10 @@ class Evaluator:
         :return: Analytical evaluator. The input parameters are specified in the following order: all edge angles in the order of graph.edges, then all node angles
         in the order of graph.nodes.
         """
-        func = lambda angles: calc_expectation_random_qaoa_analytical_p1(angles, graph, random_graph, edge_list)
+        neighbour_counts = get_neighbour_counts_random_p1(graph, random_graph, edge_list)
+        func = partial(calc_expectation_random_qaoa_analytical_p1, neighbour_counts=neighbour_counts)
         num_angles = 2
-        return Evaluator(change_sign(func), num_angles)
+        return Evaluator(change_sign(func), num_angles, num_qubits=len(graph))
 
     # @staticmethod
     # def get_evaluator_qiskit(graph: Graph, p: int, search_space: str = 'ma') -> Evaluator:
@@ -200,6 +365,9 @@ class Evaluator:
         :return: None.
         """
         self.func = fix_angles(self.func, self.num_angles, inds, values)
+        if self.grad is not None:
+            self.grad = fix_angles_gradient(self.grad, self.num_angles, inds, values)
+        self.func_batch = None
         self.num_angles -= len(inds)
 
     # @staticmethod
@@ -211,31 +379,297 @@ class Evaluator:
     #     return Evaluator(change_sign(func), num_angles)
 
 
+@dataclass
+class LazyEvaluator(Evaluator):
+    """
+    Evaluator that constructs the underlying evaluator on the first call of func, so that expensive evaluators can be created in advance and only the ones that are
+    actually used allocate memory. func given at initialization is ignored. Gradient and batched evaluation are not available.
+    :var build: Function without arguments that constructs the underlying evaluator.
+    :var evaluator: Underlying evaluator or None if it has not been constructed yet.
+    """
+    build: Callable[[], Evaluator] = None
+    evaluator: Evaluator | None = field(default=None, init=False)
+
+    def __post_init__(self):
+        self.func = self.evaluate
+        super().__post_init__()
+
+    def evaluate(self, angles: ndarray) -> float:
+        """
+        Evaluates the underlying evaluator, constructing it if necessary.
+        :param angles: 1D array of input parameters.
+        :return: Value of the underlying evaluator.
+        """
+        if self.evaluator is None:
+            self.evaluator = self.build()
+        return self.evaluator.func(angles)
+
+
+def cache_last_values(func: callable, cache_size: int = 4) -> callable:
+    """
+    Decorator that remembers results of the last few calls of a function of angles. Optimizers often query the same point repeatedly, e.g. during line searches
+    or when value and gradient are requested separately, and each query is a full simulation.
+    :param func: Function of angles only to cache.
+    :param cache_size: Number of most recent distinct points to remember.
+    :return: Function with the same results that evaluates func only for new points.
+    """
+    cache = {}
+
+    def func_cached(angles):
+        key = np.asarray(angles, dtype=float).tobytes()
+        if key not in cache:
+            if len(cache) == cache_size:
+                del cache[next(iter(cache))]
+            cache[key] = func(angles)
+        result = cache[key]
+        return result.copy() if isinstance(result, ndarray) else result
+    return func_cached
+
+
 def change_sign(func: callable) -> callable:
     """
     Decorator to change sign of the return value of a given function. Useful to carry out maximization instead of minimization.
-    :param func: Function whose sign is to be changed.
+    The wrapper is called on every optimizer step, so it takes the angles array only to avoid packing of arbitrary arguments.
+    :param func: Function of angles only whose sign is to be changed.
     :return: Function with changed sign.
     """
-    def func_changed_sign(*args, **kwargs):
-        return -func(*args, **kwargs)
+    def func_changed_sign(angles):
+        return -func(angles)
     return func_changed_sign
 
 
+GRADIENT_FREE_METHODS = {'Nelder-Mead', 'Powell', 'COBYLA'}
+LBFGSB_OPTIONS = {'maxcor': 10, 'ftol': 1e-9, 'gtol': 1e-7}
+
+worker_evaluator = None
+
+
+def init_restart_worker(evaluator: Evaluator):
+    """
+    Process pool initializer that makes the given evaluator available to `run_restart` in the worker process and limits numba kernels of the worker to a single
+    thread, so that concurrent restarts do not oversubscribe the cores. The evaluator is inherited through fork rather than pickled, since its functions are closures.
+    :param evaluator: Evaluator instance.
+    :return: None.
+    """
+    global worker_evaluator
+    worker_evaluator = evaluator
+    numba.set_num_threads(1)
+
+
+def create_worker_pool(evaluator: Evaluator, num_workers: int) -> ProcessPoolExecutor | None:
+    """
+    Creates a pool of forked single-threaded workers that have access to the given evaluator (see `init_restart_worker`).
+    Forking is unsafe if numba's threading layer has already been started with a layer other than workqueue, since tbb makes the parent process hang at exit
+    after the pool is used and omp crashes the workers. In this case a warning is logged and no pool is created. With workqueue layer, evaluator's kernels are compiled
+    before forking, so that the workers do not compile them again.
+    :param evaluator: Evaluator instance.
+    :param num_workers: Number of worker processes.
+    :return: Process pool executor or None if workers cannot be forked.
+    """
+    try:
+        threading_layer = numba.threading_layer()
+    except ValueError:
+        threading_layer = None
+    if threading_layer is not None and threading_layer != 'workqueue':
+        logging.getLogger('QAOA').warning(f'Cannot fork workers after numba started {threading_layer} threading layer, running in a single process. '
+                                          f'Set NUMBA_THREADING_LAYER=workqueue to use workers')
+        return None
+    if threading_layer == 'workqueue' or numba.config.THREADING_LAYER == 'workqueue':
+        # Kernels compiled in this process are inherited by forked workers, so compile them once here rather than in each worker
+        angles = np.zeros(evaluator.num_angles)
+        evaluator.func(angles)
+        if evaluator.grad is not None:
+            evaluator.grad(angles)
+        if evaluator.func_batch is not None:
+            evaluator.func_batch(angles[np.newaxis, :])
+    return ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('fork'), initializer=init_restart_worker, initargs=(evaluator, ))
+
+
+def get_random_generator(seed: int | None) -> np.random.Generator:
+    """
+    Returns random generator for the given seed.
+    :param seed: Seed of the generator. If None, the generator is seeded from numpy's global random state, so that np.random.seed still controls the result.
+    :return: Random generator.
+    """
+    return np.random.default_rng(random.randint(np.iinfo(np.int32).max) if seed is None else seed)
+
+
+def get_minimizer_kwargs(evaluator: Evaluator, method: str, kwargs: dict) -> dict:
+    """
+    Returns keyword arguments for `optimize.minimize` with the given method. Evaluator's gradient is passed to gradient-based methods.
+    L-BFGS-B uses LBFGSB_OPTIONS, updated with the options given explicitly.
+    :param evaluator: Evaluator instance.
+    :param method: Optimization method.
+    :param kwargs: Keyword arguments for optimizer.
+    :return: Keyword arguments including method and jac.
+    """
+    minimizer_kwargs = {'method': method, 'jac': None if method in GRADIENT_FREE_METHODS else evaluator.grad} | kwargs
+    if method == 'L-BFGS-B':
+        minimizer_kwargs['options'] = LBFGSB_OPTIONS | kwargs.get('options', {})
+    return minimizer_kwargs
+
+
+def minimize_evaluator(evaluator: Evaluator, starting_angles: ndarray, method: str, normalize_angles: bool, **kwargs) -> OptimizeResult:
+    """
+    Runs a single minimization of evaluator from a given starting point. Falls back to Nelder-Mead if the given method fails.
+    :param evaluator: Evaluator instance.
+    :param starting_angles: Starting point for optimization.
+    :param method: Optimization method.
+    :param normalize_angles: True to return optimized angles to the [-pi; pi] range.
+    :param kwargs: Keyword arguments for optimizer.
+    :return: Minimization result.
+    """
+    result = optimize.minimize(evaluator.func, starting_angles, **get_minimizer_kwargs(evaluator, method, kwargs))
+    if not result.success:
+        print(result.message)
+        result = optimize.minimize(evaluator.func, starting_angles, method='Nelder-Mead', **kwargs)
+        if not result.success:
+            print(result)
+            raise Exception('Optimization failed')
+
+    if normalize_angles:
+        result.x = normalize_qaoa_angles(result.x)
+    return result
+
+
+def run_restart(starting_angles: ndarray, method: str, normalize_angles: bool, kwargs: dict) -> OptimizeResult:
+    """
+    Runs `minimize_evaluator` for the evaluator set by `init_restart_worker` in a worker process.
+    :param starting_angles: Starting point for optimization.
+    :param method: Optimization method.
+    :param normalize_angles: True to return optimized angles to the [-pi; pi] range.
+    :param kwargs: Keyword arguments for optimizer.
+    :return: Minimization result.
+    """
+    return minimize_evaluator(worker_evaluator, starting_angles, method, normalize_angles, **kwargs)
+
+
+def evaluate_batch(evaluator: Evaluator, angles_batch: ndarray) -> ndarray:
+    """
+    Evaluates evaluator for each row of angles_batch. Uses evaluator's func_batch if it is available.
+    :param evaluator: Evaluator instance.
+    :param angles_batch: 2D array with a set of angles in each row.
+    :return: 1D array of evaluator values.
+    """
+    if evaluator.func_batch is not None:
+        return evaluator.func_batch(angles_batch)
+    return np.array([evaluator.func(angles) for angles in angles_batch])
+
+
+def run_evaluate_batch(angles_batch: ndarray) -> ndarray:
+    """
+    Runs `evaluate_batch` for the evaluator set by `init_restart_worker` in a worker process.
+    :param angles_batch: 2D array with a set of angles in each row.
+    :return: 1D array of evaluator values.
+    """
+    return evaluate_batch(worker_evaluator, angles_batch)
+
+
+def get_cache_token(value) -> str:
+    """
+    Converts argument of `optimize_qaoa_angles` to a string for the disk cache key. Unlike repr, arrays are represented by their full contents.
+    :param value: Argument value. Arrays can be nested in lists, tuples and dicts.
+    :return: String that is equal for equal values.
+    """
+    if isinstance(value, ndarray):
+        return f'ndarray({value.dtype}, {value.shape}, {hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()})'
+    elif isinstance(value, (list, tuple)):
+        return f'{type(value).__name__}({", ".join(get_cache_token(item) for item in value)})'
+    elif isinstance(value, dict):
+        return f'dict({", ".join(f"{key!r}: {get_cache_token(item)}" for key, item in sorted(value.items()))})'
+    else:
+        return repr(value)
+
+
 def optimize_qaoa_angles(evaluator: Evaluator, starting_angles: ndarray = None, method: str = 'L-BFGS-B', num_restarts: int = 1, objective_max: float = None,
-                         objective_tolerance: float = 0.9995, normalize_angles: bool = True, **kwargs) -> OptimizeResult:
+                         objective_tolerance: float = 0.9995, normalize_angles: bool = True, num_workers: int = 1, strategy: str = 'restarts', seed: int = None,
+                         warm_start: ndarray = None, warm_perturb: float = 0.05, patience: int = None, tol: float = 1e-6, time_budget: float = None, cache_dir: str = None,
+                         cache_key: tuple = None, **kwargs) -> OptimizeResult:
     """
     Wrapper around minimizer function that restarts optimization from multiple random starting points to minimize evaluator.
     :param evaluator: Evaluator instance.
     :param starting_angles: Starting point for optimization. Chosen randomly if None.
-    :param method: Optimization method.
-    :param num_restarts: Number of random starting points to try. Has no effect if specific starting point is provided.
+    :param method: Optimization method. L-BFGS-B keeps a limited-memory Hessian approximation, i.e. its cost per step is linear in the number of angles, while BFGS
+    updates a dense approximation with quadratic cost, which may still converge in fewer steps for small numbers of angles.
+    :param num_restarts: Number of random starting points to try. Has no effect if specific starting point is provided. Number of hops for basin-hopping.
     :param objective_max: Maximum achievable objective. Optimization stops if answer sufficiently close to max_objective is achieved.
     :param objective_tolerance: Fraction of 1 that controls how close the result need to be to objective_max before optimization can be stopped.
     :param normalize_angles: True to return optimized angles to the [-pi; pi] range.
+    :param num_workers: Number of single-threaded processes that run restarts concurrently. Restarts that have not started yet are cancelled once objective_max is reached.
+    Workers are forked, so this cannot be used from daemonic processes (e.g. workers of the pools in `src.parallel`). If numba parallel kernels have already run in the
+    current process, numba's threading layer has to be workqueue (NUMBA_THREADING_LAYER=workqueue), otherwise restarts run in the current process
+    (see `create_worker_pool`).
+    :param strategy: Global search strategy. 'restarts' to run independent local optimizations from random starting points, 'basinhopping' to use
+    `optimize_qaoa_angles_basinhopping` instead (patience, time_budget and num_workers are not supported in this case), 'cma' to use `optimize_qaoa_angles_cma`
+    instead (method is ignored, warm_start is used as the initial mean, patience and time_budget are not supported, and the only supported optimizer keyword
+    argument is options with maxiter and maxfun keys in this case).
+    :param seed: Seed of the random generator that draws all starting points up front. If None, the generator is seeded from numpy's global random state.
+    Starting points do not depend on num_workers.
+    :param warm_start: Angles found for a similar problem (e.g. the same graph with slightly different weights, or a lower p extended with `interp_qaoa_angles`).
+    If provided, the first restart starts from these angles with a small random perturbation, and the remaining restarts start from random points.
+    :param warm_perturb: Standard deviation of the normal perturbation added to warm_start.
+    :param patience: Number of consecutive restarts that do not improve the best objective by more than tol, after which the remaining restarts are skipped.
+    None to run all restarts.
+    :param tol: Minimum improvement of the best objective that resets patience counter.
+    :param time_budget: Time in seconds after which no new restarts are started and the best result so far is returned. None for no limit.
+    :param cache_dir: Directory where optimization results are stored on disk, or None to disable caching. Only deterministic runs are cached, i.e. seed or
+    starting_angles has to be provided, time_budget has to be None, and objective_max and patience have to be None if restarts run in multiple workers
+    (since the stopping point then depends on the order of completion).
+    :param cache_key: Tuple that identifies the evaluator, e.g. (GraphKey.create(graph).digest(), p, search_space). Has to be provided if cache_dir is given.
+    The cache file is keyed on cache_key together with all arguments that affect the result.
     :param kwargs: Keyword arguments for optimizer.
     :return: Minimization result.
     """
+    cache_path = None
+    is_order_dependent = strategy == 'restarts' and num_workers > 1 and (objective_max is not None or patience is not None)
+    is_deterministic = (seed is not None or starting_angles is not None) and time_budget is None and not is_order_dependent
+    if cache_dir is not None and is_deterministic:
+        if cache_key is None:
+            raise Exception('cache_key has to be provided together with cache_dir')
+        key_args = (cache_key, starting_angles, method, num_restarts, objective_max, objective_tolerance, normalize_angles, strategy, seed, warm_start, warm_perturb,
+                    patience, tol, kwargs)
+        cache_path = os.path.join(cache_dir, hashlib.sha256(get_cache_token(key_args).encode()).hexdigest() + '.pkl')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+
+    result = optimize_qaoa_angles_uncached(evaluator, starting_angles, method, num_restarts, objective_max, objective_tolerance, normalize_angles, num_workers,
+                                           strategy, seed, warm_start, warm_perturb, patience, tol, time_budget, **kwargs)
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path + '.tmp', 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(cache_path + '.tmp', cache_path)
+    return result
+
+
+def optimize_qaoa_angles_uncached(evaluator: Evaluator, starting_angles: ndarray, method: str, num_restarts: int, objective_max: float, objective_tolerance: float,
+                                  normalize_angles: bool, num_workers: int, strategy: str, seed: int, warm_start: ndarray, warm_perturb: float, patience: int,
+                                  tol: float, time_budget: float, **kwargs) -> OptimizeResult:
+    """
+    Implements `optimize_qaoa_angles` without the disk cache. See `optimize_qaoa_angles` for the description of parameters.
+    """
+    if strategy == 'basinhopping':
+        if patience is not None or time_budget is not None or num_workers > 1:
+            raise Exception('patience, time_budget and num_workers are not supported by basinhopping strategy')
+        if starting_angles is None and warm_start is not None:
+            starting_angles = warm_start + get_random_generator(seed).normal(0, warm_perturb, evaluator.num_angles)
+        return optimize_qaoa_angles_basinhopping(evaluator, starting_angles, method, num_restarts, objective_max=objective_max, objective_tolerance=objective_tolerance,
+                                                 normalize_angles=normalize_angles, seed=seed, **kwargs)
+    elif strategy == 'cma':
+        if patience is not None or time_budget is not None:
+            raise Exception('patience and time_budget are not supported by cma strategy')
+        options = kwargs.get('options', {})
+        unsupported = (set(kwargs) - {'options'}) | (set(options) - {'maxiter', 'maxfun'})
+        if unsupported:
+            raise Exception(f'Arguments {sorted(unsupported)} are not supported by cma strategy')
+        if starting_angles is None:
+            starting_angles = warm_start
+        return optimize_qaoa_angles_cma(evaluator, starting_angles, maxiter=options.get('maxiter', 100), maxfevals=options.get('maxfun'), objective_max=objective_max,
+                                        objective_tolerance=objective_tolerance, normalize_angles=normalize_angles, num_workers=num_workers, seed=seed)
+    elif strategy != 'restarts':
+        raise Exception('Unknown strategy')
+
     if starting_angles is not None:
         num_restarts = 1
 
@@ -243,30 +677,156 @@ def optimize_qaoa_angles(evaluator: Evaluator, starting_angles: ndarray = None,
     logger.debug('Optimization...')
     time_start = time.perf_counter()
 
-    result_best = None
-    for i in range(num_restarts):
-        if starting_angles is not None:
-            next_angles = starting_angles
-        else:
-            next_angles = random.uniform(-np.pi, np.pi, evaluator.num_angles)
-
-        result = optimize.minimize(evaluator.func, next_angles, method=method, **kwargs)
-        if not result.success:
-            print(result.message)
-            result = optimize.minimize(evaluator.func, next_angles, method='Nelder-Mead', **kwargs)
-            if not result.success:
-                print(result)
-                raise Exception('Optimization failed')
+    if starting_angles is not None:
+        all_starting_angles = np.array([starting_angles])
+    else:
+        rng = get_random_generator(seed)
+        all_starting_angles = rng.uniform(-np.pi, np.pi, (num_restarts, evaluator.num_angles))
+        if warm_start is not None:
+            all_starting_angles[0] = warm_start + rng.normal(0, warm_perturb, evaluator.num_angles)
 
-        if normalize_angles:
-            result.x = normalize_qaoa_angles(result.x)
+    result_best = None
+    num_no_improvement = 0
 
+    def update_best(result: OptimizeResult) -> bool:
+        """ Updates the best result and returns True if the remaining restarts should be skipped. """
+        nonlocal result_best, num_no_improvement
+        if result_best is not None and result.fun >= result_best.fun - tol:
+            num_no_improvement += 1
+        else:
+            num_no_improvement = 0
         if result_best is None or result.fun < result_best.fun:
             result_best = result
 
         if objective_max is not None and -result_best.fun / objective_max > objective_tolerance:
-            break
+            return True
+        if patience is not None and num_no_improvement >= patience:
+            logger.debug(f'No improvement in {patience} restarts')
+            return True
+        if time_budget is not None and time.perf_counter() - time_start > time_budget:
+            logger.debug('Time budget exceeded')
+            return True
+        return False
+
+    executor = create_worker_pool(evaluator, num_workers) if num_workers > 1 and num_restarts > 1 else None
+    if executor is not None:
+        try:
+            futures = [executor.submit(run_restart, next_angles, method, normalize_angles, kwargs) for next_angles in all_starting_angles]
+            for future in as_completed(futures):
+                if update_best(future.result()):
+                    break
+        finally:
+            executor.shutdown(cancel_futures=True)
+    else:
+        for next_angles in all_starting_angles:
+            if update_best(minimize_evaluator(evaluator, next_angles, method, normalize_angles, **kwargs)):
+                break
 
     time_finish = time.perf_counter()
     logger.debug(f'Optimization done. Time elapsed: {time_finish - time_start}')
     return result_best
+
+
+def optimize_qaoa_angles_basinhopping(evaluator: Evaluator, starting_angles: ndarray = None, method: str = 'L-BFGS-B', niter: int = 50, temperature: float = 1.0,
+                                      stepsize: float = 0.5, num_initial_samples: int = 3, objective_max: float = None, objective_tolerance: float = 0.9995,
+                                      normalize_angles: bool = True, seed: int = None, **kwargs) -> OptimizeResult:
+    """
+    Minimizes evaluator with basin-hopping, i.e. the current local minimum is randomly perturbed and the local minimum found from the perturbed point is accepted
+    according to the Metropolis criterion. Unlike independent restarts, the search keeps exploring around good minima.
+    :param evaluator: Evaluator instance.
+    :param starting_angles: Starting point for optimization. If None, the best of num_initial_samples random points is used.
+    :param method: Local optimization method.
+    :param niter: Number of basin-hopping iterations (local optimizations after the first one).
+    :param temperature: Temperature of the Metropolis acceptance criterion. Should be comparable to the difference between objectives of neighbouring local minima.
+    :param stepsize: Maximum perturbation of each angle.
+    :param num_initial_samples: Number of random points to evaluate to choose the starting point if it is not provided.
+    :param objective_max: Maximum achievable objective. Optimization stops if answer sufficiently close to max_objective is achieved.
+    :param objective_tolerance: Fraction of 1 that controls how close the result need to be to objective_max before optimization can be stopped.
+    :param normalize_angles: True to return optimized angles to the [-pi; pi] range.
+    :param seed: Seed of the random generator that draws initial samples and basin-hopping steps. If None, the generator is seeded from numpy's global random state.
+    :param kwargs: Keyword arguments for local optimizer.
+    :return: Minimization result.
+    """
+    rng = get_random_generator(seed)
+    if starting_angles is None:
+        samples = rng.uniform(-np.pi, np.pi, (num_initial_samples, evaluator.num_angles))
+        starting_angles = samples[np.argmin([evaluator.func(sample) for sample in samples])]
+
+    def callback(x, fun, accepted):
+        return objective_max is not None and -fun / objective_max > objective_tolerance
+
+    logger = logging.getLogger('QAOA')
+    logger.debug('Optimization...')
+    time_start = time.perf_counter()
+
+    result = optimize.basinhopping(evaluator.func, starting_angles, niter=niter, T=temperature, stepsize=stepsize,
+                                   minimizer_kwargs=get_minimizer_kwargs(evaluator, method, kwargs), callback=callback, seed=rng)
+    if normalize_angles:
+        result.x = normalize_qaoa_angles(result.x)
+
+    time_finish = time.perf_counter()
+    logger.debug(f'Optimization done. Time elapsed: {time_finish - time_start}')
+    return result
+
+
+def optimize_qaoa_angles_cma(evaluator: Evaluator, starting_angles: ndarray = None, sigma0: float = 0.3, popsize: int = None, maxiter: int = 100,
+                             maxfevals: int = None, objective_max: float = None, objective_tolerance: float = 0.9995, normalize_angles: bool = True, num_workers: int = 1,
+                             seed: int = None) -> OptimizeResult:
+    """
+    Minimizes evaluator with CMA-ES (requires `cma` package). Each generation is evaluated as one batch, so evaluator's func_batch is used when available and the
+    population can be split between worker processes. Gradients are not used, which makes it a better fit than BFGS for large numbers of angles with rugged landscapes.
+    :param evaluator: Evaluator instance.
+    :param starting_angles: Initial mean of the search distribution. Zeros if None.
+    :param sigma0: Initial standard deviation of the search distribution.
+    :param popsize: Number of points evaluated per generation. If None, the default of CMA-ES (4 + 3 * ln(num_angles)) is used.
+    :param maxiter: Maximum number of generations.
+    :param maxfevals: Maximum number of evaluations or None for no limit.
+    :param objective_max: Maximum achievable objective. Optimization stops if answer sufficiently close to max_objective is achieved.
+    :param objective_tolerance: Fraction of 1 that controls how close the result need to be to objective_max before optimization can be stopped.
+    :param normalize_angles: True to return optimized angles to the [-pi; pi] range.
+    :param num_workers: Number of single-threaded processes that evaluate each generation. Same restrictions as in `optimize_qaoa_angles` apply.
+    :param seed: Seed of the CMA-ES random generator. Chosen from numpy's global random state if None.
+    :return: Minimization result.
+    """
+    import cma
+
+    num_angles = evaluator.num_angles
+    if starting_angles is None:
+        starting_angles = np.zeros(num_angles)
+    if popsize is None:
+        popsize = 4 + int(3 * np.log(num_angles))
+    if seed is None:
+        seed = random.randint(np.iinfo(np.int32).max)
+    options = {'popsize': popsize, 'maxiter': maxiter, 'bounds': [[-np.pi] * num_angles, [np.pi] * num_angles], 'seed': seed, 'verbose': -9}
+    if maxfevals is not None:
+        options['maxfevals'] = maxfevals
+
+    logger = logging.getLogger('QAOA')
+    logger.debug('Optimization...')
+    time_start = time.perf_counter()
+
+    es = cma.CMAEvolutionStrategy(starting_angles, sigma0, options)
+    executor = create_worker_pool(evaluator, num_workers) if num_workers > 1 else None
+    nfev = 0
+    try:
+        while not es.stop():
+            angles_batch = np.array(es.ask())
+            if executor is None:
+                values = evaluate_batch(evaluator, angles_batch)
+            else:
+                values = np.concatenate(list(executor.map(run_evaluate_batch, np.array_split(angles_batch, num_workers))))
+            es.tell(list(angles_batch), values.tolist())
+            nfev += len(angles_batch)
+            if objective_max is not None and -es.result.fbest / objective_max > objective_tolerance:
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    result = OptimizeResult(x=np.array(es.result.xbest), fun=es.result.fbest, nfev=nfev, nit=es.result.iterations, success=True, message=str(es.stop()))
+    if normalize_angles:
+        result.x = normalize_qaoa_angles(result.x)
+
+    time_finish = time.perf_counter()
+    logger.debug(f'Optimization done. Time elapsed: {time_finish - time_start}')
+    return result
@@ -19,7 +19,7 @@ from src.angle_strategies import convert_angles_qaoa_to_ma, convert_angles_linea
 from src.data_processing import numpy_str_to_array, transfer_expectation_columns, normalize_qaoa_angles
 from src.graph_utils import get_index_edge_list
 from src.optimization import Evaluator, optimize_qaoa_angles
-from src.preprocessing import evaluate_graph_cut, evaluate_z_term
+from src.preprocessing import evaluate_graph_cut, evaluate_z_terms_batch
 
 
 @dataclass(kw_only=True)
@@ -104,14 +104,12 @@ class WorkerGeneral(WorkerBaseQAOA):
         graph = self.reader(path)
 
         target_vals = evaluate_graph_cut(graph)
-        driver_term_vals = np.array([evaluate_z_term(np.array(term), len(graph)) for term in it.combinations(range(len(graph)), 1)])
-
-        if self.space_type != '1':
-            if self.space_type == '12':
-                driver_term_vals_2 = np.array([evaluate_z_term(np.array(term), len(graph)) for term in it.combinations(range(len(graph)), 2)])
-            if self.space_type == '12e':
-                driver_term_vals_2 = np.array([evaluate_z_term(edge, len(graph)) for edge in get_index_edge_list(graph)])
-            driver_term_vals = np.append(driver_term_vals, driver_term_vals_2, axis=0)
+        driver_terms = list(it.combinations(range(len(graph)), 1))
+        if self.space_type == '12':
+            driver_terms += list(it.combinations(range(len(graph)), 2))
+        elif self.space_type == '12e':
+            driver_terms += list(get_index_edge_list(graph))
+        driver_term_vals = evaluate_z_terms_batch(driver_terms, len(graph))
 
         evaluator = Evaluator.get_evaluator_general(target_vals, driver_term_vals, self.p)
         result = optimize_qaoa_angles(evaluator, starting_angles=starting_point)
@@ -8,7 +8,7 @@ from dataclasses import dataclass
 
 import numpy as np
 from networkx import Graph
-from numba import njit
+from numba import njit, prange
 from numpy import ndarray
 
 from src.graph_utils import get_index_edge_list
@@ -53,15 +53,13 @@ class PSubset:
         target_vals = evaluate_z_term(inducing_term_new, len(node_subset))
 
         subset_term_inds = []
-        subset_term_vals = []
+        subset_terms = []
         for ind, term in enumerate(driver_terms):
             if term.issubset(current_subset):
                 subset_term_inds.append(ind)
-                term_new = np.array([ind_map[old_ind] for old_ind in term])
-                term_new_vals = evaluate_z_term(term_new, len(node_subset))
-                subset_term_vals.append(term_new_vals)
+                subset_terms.append([ind_map[old_ind] for old_ind in term])
         subset_term_inds = np.array(subset_term_inds)
-        subset_term_vals = np.array(subset_term_vals)
+        subset_term_vals = evaluate_z_terms_batch(subset_terms, len(node_subset))
 
         angle_map = []
         angles_per_layer = len(driver_terms) + total_qubits
@@ -73,6 +71,36 @@ class PSubset:
         return PSubset(current_subset, target_vals, subset_term_vals, angle_map)
 
 
+@njit
+def get_parity(x: int) -> int:
+    """
+    Returns parity of the number of set bits in a given non-negative integer.
+    :param x: Integer (up to 64 bits).
+    :return: 1 if the number of set bits is odd, 0 otherwise.
+    """
+    x ^= x >> 32
+    x ^= x >> 16
+    x ^= x >> 8
+    x ^= x >> 4
+    x ^= x >> 2
+    x ^= x >> 1
+    return x & 1
+
+
+def get_z_term_masks(terms: ndarray | list[set[int]], num_qubits: int) -> ndarray:
+    """
+    Encodes Z-terms as bitmasks over computational basis indices, so that value of term i in basis j is (-1) ** get_parity(j & masks[i]).
+    :param terms: Terms to encode. Each term is specified by indices on which Z operators act in big endian format.
+    :param num_qubits: Total number of qubits in the system.
+    :return: 1D array of size len(terms) with the corresponding bitmasks.
+    """
+    masks = np.zeros(len(terms), dtype=np.int64)
+    for i, term in enumerate(terms):
+        for bit_ind in term:
+            masks[i] |= 1 << (num_qubits - bit_ind - 1)
+    return masks
+
+
 @njit
 def evaluate_z_term(term: ndarray, num_qubits: int) -> ndarray:
     """
@@ -81,13 +109,40 @@ def evaluate_z_term(term: ndarray, num_qubits: int) -> ndarray:
     :param num_qubits: Total number of qubits in the system.
     :return: 1D array of size 2 ** num_qubits with the values of the given Z-term in the computational basis.
     """
-    term_values = np.zeros(2 ** num_qubits, dtype=np.int8)
+    mask = 0
+    for bit_ind in term:
+        mask |= 1 << (num_qubits - bit_ind - 1)
+    term_values = np.empty(2 ** num_qubits, dtype=np.int8)
     for i in range(len(term_values)):
-        bin_vals = [i >> num_qubits - bit_ind - 1 & 1 for bit_ind in term]
-        term_values[i] = (-1) ** sum(bin_vals)
+        term_values[i] = 1 - 2 * get_parity(i & mask)
     return term_values
 
 
+@njit(parallel=True)
+def evaluate_z_term_masks(term_masks: ndarray, num_qubits: int) -> ndarray:
+    """
+    Evaluates Z-terms given as bitmasks (see `get_z_term_masks`) in the computational basis with given number of qubits. Fills all terms in one pass over the basis.
+    :param term_masks: 1D array of bitmasks of qubits in each term.
+    :param num_qubits: Total number of qubits in the system.
+    :return: 2D array of size len(term_masks) x 2 ** num_qubits with the values of each term in the computational basis.
+    """
+    term_values = np.empty((len(term_masks), 2 ** num_qubits), dtype=np.int8)
+    for i in prange(term_values.shape[1]):
+        for j in range(len(term_masks)):
+            term_values[j, i] = 1 - 2 * get_parity(i & term_masks[j])
+    return term_values
+
+
+def evaluate_z_terms_batch(terms: ndarray | list[set[int]], num_qubits: int) -> ndarray:
+    """
+    Batch version of `evaluate_z_term`.
+    :param terms: Terms to evaluate. Each term is specified by indices on which Z operators act in big endian format.
+    :param num_qubits: Total number of qubits in the system.
+    :return: 2D array of size len(terms) x 2 ** num_qubits with the values of each term in the computational basis.
+    """
+    return evaluate_z_term_masks(get_z_term_masks(terms, num_qubits), num_qubits)
+
+
 @njit
 def evaluate_edge_cut(edge: ndarray, num_nodes: int) -> ndarray:
     """
@@ -97,7 +152,7 @@ def evaluate_edge_cut(edge: ndarray, num_nodes: int) -> ndarray:
     :return: 1D array of size 2 ** num_qubits with 1 if the given edge is cut in the corresponding basis or 0 otherwise.
     """
     z_term = evaluate_z_term(edge, num_nodes)
-    return (1 - z_term) // 2
+    return ((1 - z_term) // 2).astype(np.int8)
 
 
 @njit
@@ -108,9 +163,11 @@ def evaluate_graph_cut_index_edge(index_edge_list: ndarray, num_nodes: int) -> n
     :param num_nodes: Total number of nodes in the graph.
     :return: 1D array of size 2 ** num_qubits with the cut values for each computational basis.
     """
-    res = np.zeros(2 ** num_nodes, dtype=np.int32)
+    res = np.zeros(2 ** num_nodes, dtype=np.int16)
     for edge in index_edge_list:
-        res += evaluate_edge_cut(edge, num_nodes)
+        mask = (1 << (num_nodes - edge[0] - 1)) | (1 << (num_nodes - edge[1] - 1))
+        for i in range(len(res)):
+            res[i] += get_parity(i & mask)
     return res
 
 
@@ -3,25 +3,27 @@ Functions that evaluate expectation values in QAOA directly through quantum simu
 """
 import numpy as np
 from networkx import Graph
-from numba import njit
+from numba import njit, prange
 from numpy import ndarray, sin, cos
 
 from src.graph_utils import get_index_edge_list
-from src.preprocessing import PSubset, evaluate_edge_cut
+from src.preprocessing import PSubset, evaluate_edge_cut, get_parity
 
 
 @njit
 def apply_driver(term_angles: ndarray, term_vals: ndarray, psi: ndarray) -> ndarray:
     """
     Applies exponent of the driver function with given angles to a given state psi.
+    All terms are diagonal, so their phases are summed first and exponentiated in a single pass over the state.
     :param term_angles: 1D array with the angles for each term.
     :param term_vals: 2D array of size #terms x 2 ** #qubits. Each row is an array of values of a term in Z-expansion of the driver function for each computational basis.
     :param psi: Current quantum state vector.
     :return: New quantum state vector.
     """
+    phases = np.zeros(term_vals.shape[1])
     for i in range(len(term_angles)):
-        psi = np.exp(-1j * term_angles[i] * term_vals[i, :]) * psi
-    return psi
+        phases += term_angles[i] * term_vals[i, :]
+    return np.exp(-1j * phases) * psi
 
 
 @njit
@@ -44,6 +46,28 @@ def get_exp_y(alpha: float) -> ndarray:
                      [sin(alpha), cos(alpha)]])
 
 
+@njit(parallel=True, fastmath=True)
+def apply_unitary_one_qubit_inplace(unitary: ndarray, psi: ndarray, bit_ind: int, num_bits: int):
+    """
+    Applies a given single qubit unitary matrix (2x2) to a specified qubit (target), overwriting the given state.
+    Walks over the pairs of basis states that differ in the target bit only, so each amplitude is read and written exactly once.
+    :param unitary: Unitary matrix to apply.
+    :param psi: Current quantum state vector. Modified in place.
+    :param bit_ind: Target bit index in big endian notation.
+    :param num_bits: Total number of bits.
+    """
+    bit_ind_right = num_bits - bit_ind - 1
+    low_mask = (1 << bit_ind_right) - 1
+    for i in prange(len(psi) // 2):
+        # Insert 0 at the target bit position to get the pair of basis states that differ in the target bit only
+        ind_0 = ((i >> bit_ind_right) << (bit_ind_right + 1)) | (i & low_mask)
+        ind_1 = ind_0 | (1 << bit_ind_right)
+        psi_0 = psi[ind_0]
+        psi_1 = psi[ind_1]
+        psi[ind_0] = unitary[0, 0] * psi_0 + unitary[0, 1] * psi_1
+        psi[ind_1] = unitary[1, 0] * psi_0 + unitary[1, 1] * psi_1
+
+
 @njit
 def apply_unitary_one_qubit(unitary: ndarray, psi: ndarray, bit_ind: int, num_bits: int) -> ndarray:
     """
@@ -54,13 +78,8 @@ def apply_unitary_one_qubit(unitary: ndarray, psi: ndarray, bit_ind: int, num_bi
     :param num_bits: Total number of bits.
     :return: New quantum state vector.
     """
-    res = np.zeros(np.shape(psi), dtype=np.complex128)
-    bit_ind_right = num_bits - bit_ind - 1
-    for i in range(len(psi)):
-        target_val = i >> bit_ind_right & 1
-        neighbour = i + (-1) ** target_val * 2 ** bit_ind_right
-        res[i] += psi[i] * unitary[target_val, target_val]  # basis remained the same
-        res[neighbour] += psi[i] * unitary[1 - target_val, target_val]  # basis changed in specified bit
+    res = psi.astype(np.complex128)
+    apply_unitary_one_qubit_inplace(unitary, res, bit_ind, num_bits)
     return res
 
 
@@ -82,15 +101,97 @@ def apply_mixer_individual(betas: ndarray, psi: ndarray, apply_y: bool = False)
     return psi
 
 
+@njit(parallel=True, fastmath=True)
+def apply_mixer_individual_inplace(betas: ndarray, psi: ndarray, apply_y: bool = False, tile_bits: int = 12):
+    """
+    In-place version of `apply_mixer_individual`.
+    Gates on the qubits corresponding to the lowest tile_bits bits only mix amplitudes within aligned blocks of 2 ** tile_bits states,
+    so they are applied block by block while each block stays in cache. The remaining qubits are applied with one sweep over the state each.
+    :param betas: 1D array with rotation angles for each qubit. Size: number of qubits.
+    :param psi: Current quantum state vector. Modified in place.
+    :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :param tile_bits: Log2 of the number of amplitudes in a block. Default 2 ** 12 complex128 amplitudes (64 KB) fit in L2 cache.
+    """
+    num_bits = len(betas)
+    unitaries = np.empty((num_bits, 2, 2), dtype=np.complex128)
+    for bit_ind in range(num_bits):
+        unitaries[bit_ind] = get_exp_x(betas[bit_ind])
+        if apply_y:
+            unitaries[bit_ind] = np.dot(get_exp_y(betas[bit_ind]).astype(np.complex128), unitaries[bit_ind])
+
+    tile_bits = min(tile_bits, num_bits)
+    for tile_ind in prange(len(psi) >> tile_bits):
+        tile_start = tile_ind << tile_bits
+        for bit_ind_right in range(tile_bits):
+            u00, u01, u10, u11 = unitaries[num_bits - bit_ind_right - 1].ravel()
+            low_mask = (1 << bit_ind_right) - 1
+            for i in range(1 << (tile_bits - 1)):
+                ind_0 = tile_start | ((i >> bit_ind_right) << (bit_ind_right + 1)) | (i & low_mask)
+                ind_1 = ind_0 | (1 << bit_ind_right)
+                psi_0 = psi[ind_0]
+                psi_1 = psi[ind_1]
+                psi[ind_0] = u00 * psi_0 + u01 * psi_1
+                psi[ind_1] = u10 * psi_0 + u11 * psi_1
+
+    for bit_ind in range(num_bits - tile_bits):
+        apply_unitary_one_qubit_inplace(unitaries[bit_ind], psi, bit_ind, num_bits)
+
+
+@njit(parallel=True, fastmath=True)
+def apply_qaoa_layer(gammas: ndarray, betas: ndarray, term_vals: ndarray, psi: ndarray, apply_y: bool = False) -> ndarray:
+    """
+    Applies one QAOA layer (driver, then mixer) to a given state psi. Equivalent to `apply_driver` followed by `apply_mixer_individual`, but fused into a single kernel
+    that updates one state buffer in place and parallelizes each sweep over the computational basis.
+    :param gammas: 1D array with the angles for each driver term.
+    :param betas: 1D array with rotation angles for each qubit. Size: number of qubits.
+    :param term_vals: 2D array of size #terms x 2 ** #qubits. Each row is an array of values of a term in Z-expansion of the driver function for each computational basis.
+    :param psi: Current quantum state vector.
+    :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :return: New quantum state vector of the same precision as psi.
+    """
+    res = np.empty_like(psi)
+    for i in prange(len(psi)):
+        phase = 0.
+        for j in range(len(gammas)):
+            phase += gammas[j] * term_vals[j, i]
+        res[i] = np.exp(-1j * phase) * psi[i]
+    apply_mixer_individual_inplace(betas, res, apply_y)
+    return res
+
+
+@njit(parallel=True, fastmath=True)
+def apply_qaoa_layer_masks(gammas: ndarray, betas: ndarray, term_masks: ndarray, psi: ndarray, apply_y: bool = False) -> ndarray:
+    """
+    Same as `apply_qaoa_layer`, but the driver terms are given as bitmasks (see `get_z_term_masks`) and their values are computed on the fly instead of being read from a table.
+    :param gammas: 1D array with the angles for each driver term.
+    :param betas: 1D array with rotation angles for each qubit. Size: number of qubits.
+    :param term_masks: 1D array of bitmasks of qubits in each term in Z-expansion of the driver function.
+    :param psi: Current quantum state vector.
+    :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :return: New quantum state vector of the same precision as psi.
+    """
+    res = np.empty_like(psi)
+    for i in prange(len(psi)):
+        phase = 0.
+        for j in range(len(gammas)):
+            phase += gammas[j] * (1 - 2 * get_parity(i & term_masks[j]))
+        res[i] = np.exp(-1j * phase) * psi[i]
+    apply_mixer_individual_inplace(betas, res, apply_y)
+    return res
+
+
 @njit
 def calc_expectation_diagonal(psi: ndarray, diagonal_vals: ndarray) -> float:
     """
     Calculates expectation value of a given diagonal operator for a given state psi.
     :param psi: Quantum state vector.
-    :param diagonal_vals: Values of a diagonal operator.
+    :param diagonal_vals: Real values of a diagonal operator.
     :return: Expectation value of a given operator in the given state.
     """
-    return np.real(np.vdot(psi, diagonal_vals * psi))
+    expectation = 0.
+    for i in range(len(psi)):
+        expectation += diagonal_vals[i] * (psi[i].real ** 2 + psi[i].imag ** 2)
+    return expectation
 
 
 def calc_expectation_per_edge(psi: ndarray, graph: Graph) -> list[float]:
@@ -109,27 +210,49 @@ def calc_expectation_per_edge(psi: ndarray, graph: Graph) -> list[float]:
 
 
 @njit
-def construct_qaoa_state(angles: ndarray, driver_term_vals: ndarray, p: int, apply_y: bool = False) -> ndarray:
+def construct_qaoa_state(angles: ndarray, driver_term_vals: ndarray, p: int, apply_y: bool = False, dtype: type = np.complex128) -> ndarray:
     """
     Constructs QAOA state corresponding to the given angles and terms, assuming standard initial state.
     :param angles: 1D array of angles for all layers. Same format as in `calc_expectation_general_qaoa`.
     :param driver_term_vals: 2D array of size #terms x 2 ** #qubits. Each row is an array of values of a driver function's term for each computational basis.
     :param p: Number of QAOA layers.
     :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :param dtype: Complex data type of the state vector. np.complex64 halves memory traffic at the cost of precision.
     :return: Resulting quantum state vector.
     """
-    psi = np.ones(driver_term_vals.shape[1], dtype=np.complex128) / np.sqrt(driver_term_vals.shape[1])
+    psi = np.full(driver_term_vals.shape[1], 1 / np.sqrt(driver_term_vals.shape[1]), dtype=dtype)
     num_params_per_layer = len(angles) // p
     for i in range(p):
         layer_params = angles[i * num_params_per_layer:(i + 1) * num_params_per_layer]
         gammas = layer_params[:driver_term_vals.shape[0]]
-        psi = apply_driver(gammas, driver_term_vals, psi)
         betas = layer_params[driver_term_vals.shape[0]:]
-        psi = apply_mixer_individual(betas, psi, apply_y)
+        psi = apply_qaoa_layer(gammas, betas, driver_term_vals, psi, apply_y)
+    return psi
+
+
+@njit
+def construct_qaoa_state_masks(angles: ndarray, driver_term_masks: ndarray, num_qubits: int, p: int, apply_y: bool = False, dtype: type = np.complex128) -> ndarray:
+    """
+    Same as `construct_qaoa_state`, but the driver terms are given as bitmasks (see `get_z_term_masks`).
+    :param angles: 1D array of angles for all layers. Same format as in `calc_expectation_general_qaoa`.
+    :param driver_term_masks: 1D array of bitmasks of qubits in each term in Z-expansion of the driver function.
+    :param num_qubits: Total number of qubits.
+    :param p: Number of QAOA layers.
+    :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :param dtype: Complex data type of the state vector. np.complex64 halves memory traffic at the cost of precision.
+    :return: Resulting quantum state vector.
+    """
+    psi = np.full(2 ** num_qubits, 1 / np.sqrt(2 ** num_qubits), dtype=dtype)
+    num_params_per_layer = len(angles) // p
+    for i in range(p):
+        layer_params = angles[i * num_params_per_layer:(i + 1) * num_params_per_layer]
+        gammas = layer_params[:len(driver_term_masks)]
+        betas = layer_params[len(driver_term_masks):]
+        psi = apply_qaoa_layer_masks(gammas, betas, driver_term_masks, psi, apply_y)
     return psi
 
 
-def calc_expectation_general_qaoa(angles: ndarray, driver_term_vals: ndarray, p: int, target_vals: ndarray, apply_y: bool = False) -> float:
+def calc_expectation_general_qaoa(angles: ndarray, driver_term_vals: ndarray, p: int, target_vals: ndarray, apply_y: bool = False, dtype: type = np.complex128) -> float:
     """
     Calculates target function expectation value for given set of driver terms and corresponding weights.
     :param angles: 1D array of angles for all layers. Format: first, term angles for 1st layer in the same order as rows of driver_term_vals,
@@ -138,13 +261,292 @@ def calc_expectation_general_qaoa(angles: ndarray, driver_term_vals: ndarray, p:
     :param p: Number of QAOA layers.
     :param target_vals: 1D array of target function values for all computational basis states.
     :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :param dtype: Complex data type of the state vector. np.complex64 halves memory traffic at the cost of precision.
     :return: Expectation value of the target function in the state corresponding to the given parameters and terms.
     """
-    psi = construct_qaoa_state(angles, driver_term_vals, p, apply_y)
+    psi = construct_qaoa_state(angles, driver_term_vals, p, apply_y, dtype)
     expectation = calc_expectation_diagonal(psi, target_vals)
     return expectation
 
 
+def calc_expectation_general_qaoa_masks(angles: ndarray, driver_term_masks: ndarray, p: int, target_vals: ndarray, apply_y: bool = False, dtype: type = np.complex128) -> float:
+    """
+    Same as `calc_expectation_general_qaoa`, but the driver terms are given as bitmasks (see `get_z_term_masks`).
+    :param angles: 1D array of angles for all layers. Same format as in `calc_expectation_general_qaoa`.
+    :param driver_term_masks: 1D array of bitmasks of qubits in each term in Z-expansion of the driver function.
+    :param p: Number of QAOA layers.
+    :param target_vals: 1D array of target function values for all computational basis states.
+    :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :param dtype: Complex data type of the state vector. np.complex64 halves memory traffic at the cost of precision.
+    :return: Expectation value of the target function in the state corresponding to the given parameters and terms.
+    """
+    num_qubits = len(target_vals).bit_length() - 1
+    psi = construct_qaoa_state_masks(angles, driver_term_masks, num_qubits, p, apply_y, dtype)
+    expectation = calc_expectation_diagonal(psi, target_vals)
+    return expectation
+
+
+@njit(parallel=True, fastmath=True)
+def apply_qaoa_layer_batched(gammas: ndarray, betas: ndarray, term_vals: ndarray, psi: ndarray, apply_y: bool = False) -> ndarray:
+    """
+    Batched version of `apply_qaoa_layer` that applies a layer with different angles to each of several states. The driver phase pass reads each column of term_vals once
+    for all states.
+    :param gammas: 2D array of size #states x #terms with the driver angles for each state.
+    :param betas: 2D array of size #states x #qubits with the mixer angles for each state.
+    :param term_vals: 2D array of size #terms x 2 ** #qubits. Each row is an array of values of a term in Z-expansion of the driver function for each computational basis.
+    :param psi: 2D array of size #states x 2 ** #qubits with the current quantum state vectors.
+    :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :return: New quantum state vectors of the same precision as psi.
+    """
+    res = np.empty_like(psi)
+    block_size = min(psi.shape[1], 1 << 12)
+    for block_ind in prange(psi.shape[1] // block_size):
+        for k in range(psi.shape[0]):
+            for i in range(block_ind * block_size, (block_ind + 1) * block_size):
+                phase = 0.
+                for j in range(gammas.shape[1]):
+                    phase += gammas[k, j] * term_vals[j, i]
+                res[k, i] = np.exp(-1j * phase) * psi[k, i]
+    for k in range(psi.shape[0]):
+        apply_mixer_individual_inplace(betas[k], res[k], apply_y)
+    return res
+
+
+@njit(parallel=True, fastmath=True)
+def apply_qaoa_layer_batched_masks(gammas: ndarray, betas: ndarray, term_masks: ndarray, psi: ndarray, apply_y: bool = False) -> ndarray:
+    """
+    Same as `apply_qaoa_layer_batched`, but the driver terms are given as bitmasks (see `get_z_term_masks`).
+    :param gammas: 2D array of size #states x #terms with the driver angles for each state.
+    :param betas: 2D array of size #states x #qubits with the mixer angles for each state.
+    :param term_masks: 1D array of bitmasks of qubits in each term in Z-expansion of the driver function.
+    :param psi: 2D array of size #states x 2 ** #qubits with the current quantum state vectors.
+    :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :return: New quantum state vectors of the same precision as psi.
+    """
+    res = np.empty_like(psi)
+    block_size = min(psi.shape[1], 1 << 12)
+    for block_ind in prange(psi.shape[1] // block_size):
+        for k in range(psi.shape[0]):
+            for i in range(block_ind * block_size, (block_ind + 1) * block_size):
+                phase = 0.
+                for j in range(len(term_masks)):
+                    phase += gammas[k, j] * (1 - 2 * get_parity(i & term_masks[j]))
+                res[k, i] = np.exp(-1j * phase) * psi[k, i]
+    for k in range(psi.shape[0]):
+        apply_mixer_individual_inplace(betas[k], res[k], apply_y)
+    return res
+
+
+@njit(parallel=True, fastmath=True)
+def calc_expectation_diagonal_batched(psi: ndarray, diagonal_vals: ndarray) -> ndarray:
+    """
+    Batched version of `calc_expectation_diagonal`.
+    :param psi: 2D array of size #states x 2 ** #qubits with quantum state vectors.
+    :param diagonal_vals: Real values of a diagonal operator.
+    :return: 1D array with expectation value of a given operator in each state.
+    """
+    expectations = np.zeros(psi.shape[0])
+    for k in prange(psi.shape[0]):
+        for i in range(psi.shape[1]):
+            expectations[k] += diagonal_vals[i] * (psi[k, i].real ** 2 + psi[k, i].imag ** 2)
+    return expectations
+
+
+def calc_expectation_general_qaoa_batched(angles_batch: ndarray, driver_term_vals: ndarray, p: int, target_vals: ndarray, apply_y: bool = False,
+                                          dtype: type = np.complex128) -> ndarray:
+    """
+    Batched version of `calc_expectation_general_qaoa` that simulates the circuits for several sets of angles together.
+    :param angles_batch: 2D array where each row is a set of angles in the same format as in `calc_expectation_general_qaoa`.
+    :param driver_term_vals: 2D array of size #terms x 2 ** #qubits. Each row is an array of values of a driver function's term for each computational basis.
+    :param p: Number of QAOA layers.
+    :param target_vals: 1D array of target function values for all computational basis states.
+    :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :param dtype: Complex data type of the state vectors. np.complex64 halves memory traffic at the cost of precision.
+    :return: 1D array of expectation values of the target function for each row of angles_batch.
+    """
+    psi = np.full((angles_batch.shape[0], driver_term_vals.shape[1]), 1 / np.sqrt(driver_term_vals.shape[1]), dtype=dtype)
+    num_params_per_layer = angles_batch.shape[1] // p
+    for i in range(p):
+        layer_params = angles_batch[:, i * num_params_per_layer:(i + 1) * num_params_per_layer]
+        gammas = np.ascontiguousarray(layer_params[:, :driver_term_vals.shape[0]])
+        betas = np.ascontiguousarray(layer_params[:, driver_term_vals.shape[0]:])
+        psi = apply_qaoa_layer_batched(gammas, betas, driver_term_vals, psi, apply_y)
+    return calc_expectation_diagonal_batched(psi, target_vals)
+
+
+def calc_expectation_general_qaoa_batched_masks(angles_batch: ndarray, driver_term_masks: ndarray, p: int, target_vals: ndarray, apply_y: bool = False,
+                                                dtype: type = np.complex128) -> ndarray:
+    """
+    Same as `calc_expectation_general_qaoa_batched`, but the driver terms are given as bitmasks (see `get_z_term_masks`).
+    :param angles_batch: 2D array where each row is a set of angles in the same format as in `calc_expectation_general_qaoa`.
+    :param driver_term_masks: 1D array of bitmasks of qubits in each term in Z-expansion of the driver function.
+    :param p: Number of QAOA layers.
+    :param target_vals: 1D array of target function values for all computational basis states.
+    :param apply_y: True to apply a layer of Y-mixers with the same angles.
+    :param dtype: Complex data type of the state vectors. np.complex64 halves memory traffic at the cost of precision.
+    :return: 1D array of expectation values of the target function for each row of angles_batch.
+    """
+    psi = np.full((angles_batch.shape[0], len(target_vals)), 1 / np.sqrt(len(target_vals)), dtype=dtype)
+    num_params_per_layer = angles_batch.shape[1] // p
+    for i in range(p):
+        layer_params = angles_batch[:, i * num_params_per_layer:(i + 1) * num_params_per_layer]
+        gammas = np.ascontiguousarray(layer_params[:, :len(driver_term_masks)])
+        betas = np.ascontiguousarray(layer_params[:, len(driver_term_masks):])
+        psi = apply_qaoa_layer_batched_masks(gammas, betas, driver_term_masks, psi, apply_y)
+    return calc_expectation_diagonal_batched(psi, target_vals)
+
+
+@njit(parallel=True, fastmath=True)
+def calc_mixer_derivatives(psi: ndarray, lam: ndarray, num_bits: int) -> ndarray:
+    """
+    Calculates derivatives of expectation with respect to the angle of each qubit in a mixer layer.
+    :param psi: Quantum state vector right after the mixer layer.
+    :param lam: Target operator applied to the final state and propagated back to the same point as psi.
+    :param num_bits: Total number of bits.
+    :return: 1D array of derivatives in the qubits order.
+    """
+    derivatives = np.zeros(num_bits)
+    for bit_ind in range(num_bits):
+        bit_ind_right = num_bits - bit_ind - 1
+        low_mask = (1 << bit_ind_right) - 1
+        derivative = 0.
+        for i in prange(len(psi) // 2):
+            ind_0 = ((i >> bit_ind_right) << (bit_ind_right + 1)) | (i & low_mask)
+            ind_1 = ind_0 | (1 << bit_ind_right)
+            derivative += (np.conj(lam[ind_0]) * psi[ind_1] + np.conj(lam[ind_1]) * psi[ind_0]).imag
+        derivatives[bit_ind] = 2 * derivative
+    return derivatives
+
+
+@njit(parallel=True, fastmath=True)
+def calc_driver_derivatives(term_vals: ndarray, psi: ndarray, lam: ndarray) -> ndarray:
+    """
+    Calculates derivatives of expectation with respect to the angle of each term in a driver layer.
+    :param term_vals: 2D array of size #terms x 2 ** #qubits. Each row is an array of values of a term in Z-expansion of the driver function for each computational basis.
+    :param psi: Quantum state vector right after the driver layer.
+    :param lam: Target operator applied to the final state and propagated back to the same point as psi.
+    :return: 1D array of derivatives in the same order as rows of term_vals.
+    """
+    derivatives = np.zeros(term_vals.shape[0])
+    for j in range(term_vals.shape[0]):
+        derivative = 0.
+        for i in prange(len(psi)):
+            derivative += term_vals[j, i] * (np.conj(lam[i]) * psi[i]).imag
+        derivatives[j] = 2 * derivative
+    return derivatives
+
+
+@njit(parallel=True, fastmath=True)
+def calc_driver_derivatives_masks(term_masks: ndarray, psi: ndarray, lam: ndarray) -> ndarray:
+    """
+    Same as `calc_driver_derivatives`, but the driver terms are given as bitmasks (see `get_z_term_masks`).
+    :param term_masks: 1D array of bitmasks of qubits in each term in Z-expansion of the driver function.
+    :param psi: Quantum state vector right after the driver layer.
+    :param lam: Target operator applied to the final state and propagated back to the same point as psi.
+    :return: 1D array of derivatives in the same order as term_masks.
+    """
+    derivatives = np.zeros(len(term_masks))
+    for j in range(len(term_masks)):
+        derivative = 0.
+        for i in prange(len(psi)):
+            derivative += (1 - 2 * get_parity(i & term_masks[j])) * (np.conj(lam[i]) * psi[i]).imag
+        derivatives[j] = 2 * derivative
+    return derivatives
+
+
+@njit(parallel=True, fastmath=True)
+def apply_driver_inverse_inplace(gammas: ndarray, term_vals: ndarray, psi: ndarray, lam: ndarray):
+    """
+    Applies inverse of the driver exponent with given angles to two states in place.
+    :param gammas: 1D array with the angles for each driver term.
+    :param term_vals: 2D array of size #terms x 2 ** #qubits. Each row is an array of values of a term in Z-expansion of the driver function for each computational basis.
+    :param psi: First quantum state vector. Modified in place.
+    :param lam: Second quantum state vector. Modified in place.
+    """
+    for i in prange(len(psi)):
+        phase = 0.
+        for j in range(len(gammas)):
+            phase += gammas[j] * term_vals[j, i]
+        exp_phase = np.exp(1j * phase)
+        psi[i] *= exp_phase
+        lam[i] *= exp_phase
+
+
+@njit(parallel=True, fastmath=True)
+def apply_driver_inverse_inplace_masks(gammas: ndarray, term_masks: ndarray, psi: ndarray, lam: ndarray):
+    """
+    Same as `apply_driver_inverse_inplace`, but the driver terms are given as bitmasks (see `get_z_term_masks`).
+    :param gammas: 1D array with the angles for each driver term.
+    :param term_masks: 1D array of bitmasks of qubits in each term in Z-expansion of the driver function.
+    :param psi: First quantum state vector. Modified in place.
+    :param lam: Second quantum state vector. Modified in place.
+    """
+    for i in prange(len(psi)):
+        phase = 0.
+        for j in range(len(gammas)):
+            phase += gammas[j] * (1 - 2 * get_parity(i & term_masks[j]))
+        exp_phase = np.exp(1j * phase)
+        psi[i] *= exp_phase
+        lam[i] *= exp_phase
+
+
+def calc_gradient_general_qaoa(angles: ndarray, driver_term_vals: ndarray, p: int, target_vals: ndarray, dtype: type = np.complex128) -> ndarray:
+    """
+    Calculates gradient of `calc_expectation_general_qaoa` with respect to angles by adjoint differentiation, i.e. the final state and the target operator applied to it
+    are propagated back through the circuit, and each derivative is evaluated where the corresponding gate is applied. Costs about as much as a few expectation evaluations,
+    regardless of the number of angles. Y-mixers are not supported.
+    :param angles: 1D array of angles for all layers. Same format as in `calc_expectation_general_qaoa`.
+    :param driver_term_vals: 2D array of size #terms x 2 ** #qubits. Each row is an array of values of a driver function's term for each computational basis.
+    :param p: Number of QAOA layers.
+    :param target_vals: 1D array of target function values for all computational basis states.
+    :param dtype: Complex data type of the state vector. np.complex64 halves memory traffic at the cost of precision.
+    :return: 1D array of derivatives with respect to each angle, in the same order as angles.
+    """
+    psi = construct_qaoa_state(angles, driver_term_vals, p, False, dtype)
+    lam = (target_vals * psi).astype(psi.dtype)
+    gradient = np.empty(len(angles))
+    num_terms = driver_term_vals.shape[0]
+    num_params_per_layer = len(angles) // p
+    for i in range(p - 1, -1, -1):
+        layer_start = i * num_params_per_layer
+        gammas = angles[layer_start:layer_start + num_terms]
+        betas = angles[layer_start + num_terms:layer_start + num_params_per_layer]
+        gradient[layer_start + num_terms:layer_start + num_params_per_layer] = calc_mixer_derivatives(psi, lam, len(betas))
+        apply_mixer_individual_inplace(-betas, psi)
+        apply_mixer_individual_inplace(-betas, lam)
+        gradient[layer_start:layer_start + num_terms] = calc_driver_derivatives(driver_term_vals, psi, lam)
+        apply_driver_inverse_inplace(gammas, driver_term_vals, psi, lam)
+    return gradient
+
+
+def calc_gradient_general_qaoa_masks(angles: ndarray, driver_term_masks: ndarray, p: int, target_vals: ndarray, dtype: type = np.complex128) -> ndarray:
+    """
+    Same as `calc_gradient_general_qaoa`, but the driver terms are given as bitmasks (see `get_z_term_masks`).
+    :param angles: 1D array of angles for all layers. Same format as in `calc_expectation_general_qaoa`.
+    :param driver_term_masks: 1D array of bitmasks of qubits in each term in Z-expansion of the driver function.
+    :param p: Number of QAOA layers.
+    :param target_vals: 1D array of target function values for all computational basis states.
+    :param dtype: Complex data type of the state vector. np.complex64 halves memory traffic at the cost of precision.
+    :return: 1D array of derivatives with respect to each angle, in the same order as angles.
+    """
+    num_qubits = len(target_vals).bit_length() - 1
+    psi = construct_qaoa_state_masks(angles, driver_term_masks, num_qubits, p, False, dtype)
+    lam = (target_vals * psi).astype(psi.dtype)
+    gradient = np.empty(len(angles))
+    num_terms = len(driver_term_masks)
+    num_params_per_layer = len(angles) // p
+    for i in range(p - 1, -1, -1):
+        layer_start = i * num_params_per_layer
+        gammas = angles[layer_start:layer_start + num_terms]
+        betas = angles[layer_start + num_terms:layer_start + num_params_per_layer]
+        gradient[layer_start + num_terms:layer_start + num_params_per_layer] = calc_mixer_derivatives(psi, lam, len(betas))
+        apply_mixer_individual_inplace(-betas, psi)
+        apply_mixer_individual_inplace(-betas, lam)
+        gradient[layer_start:layer_start + num_terms] = calc_driver_derivatives_masks(driver_term_masks, psi, lam)
+        apply_driver_inverse_inplace_masks(gammas, driver_term_masks, psi, lam)
+    return gradient
+
+
 def calc_expectation_general_qaoa_subsets(angles: ndarray, subsets: list[PSubset], subset_coeffs: list[float], p: int) -> float:
     """
     Calculates objective expectation for given angles with generalized QAOA ansatz by separate simulation of each p-subset.
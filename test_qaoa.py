@@ -1,10 +1,28 @@
 """
 QAOA tests.
 """
+import os
+import subprocess
+import sys
+from functools import reduce
+
 import networkx as nx
+import numpy as np
 import pytest
+from scipy import optimize
 
+from src.analytical import TopologyP1, calc_expectation_qaoa_analytical_p1_grid
 from src.optimization import optimize_qaoa_angles, Evaluator
+from src.preprocessing import evaluate_z_term, get_z_term_masks
+from src.simulation.plain import apply_mixer_individual, apply_qaoa_layer, apply_qaoa_layer_masks, get_exp_x, get_exp_y
+
+
+@pytest.fixture
+def weighted_gnp():
+    """ Random graph with 8 nodes and distinct edge weights (includes triangles). """
+    graph = nx.gnp_random_graph(8, 0.5, seed=0)
+    nx.set_edge_attributes(graph, {edge: 0.5 + i / 10 for i, edge in enumerate(graph.edges)}, 'weight')
+    return graph
 
 
 class TestMAQAOA:
@@ -73,3 +91,131 @@ class TestMAQAOA:
         evaluator = Evaluator.get_evaluator_standard_maxcut(reg4_n7_e14, 2)
         objective_best = optimize_qaoa_angles(evaluator)[0]
         assert abs(objective_best - 12) < 1e-2
+
+    def test_ma_qaoa_analytical_gradient(self, weighted_gnp):
+        """ Tests that analytical gradient of MA-QAOA expectation for p=1 matches finite differences on a weighted graph with triangles. """
+        evaluator = Evaluator.get_evaluator_standard_maxcut_analytical(weighted_gnp)
+        angles = np.random.default_rng(0).uniform(-np.pi, np.pi, evaluator.num_angles)
+        assert np.allclose(evaluator.grad(angles), optimize.approx_fprime(angles, evaluator.func, 1e-7), atol=1e-5)
+
+    def test_qaoa_analytical_grid(self, weighted_gnp):
+        """ Tests that analytical QAOA expectation evaluated on a grid of angles matches the analytical evaluator at each grid point. """
+        evaluator = Evaluator.get_evaluator_standard_maxcut_analytical(weighted_gnp, use_multi_angle=False)
+        gammas = np.linspace(-np.pi, np.pi, 7)
+        betas = np.linspace(-np.pi / 2, np.pi / 2, 5)
+        grid = calc_expectation_qaoa_analytical_p1_grid(gammas, betas, TopologyP1.create(weighted_gnp))
+        expected = [[-evaluator.func(np.array([gamma, beta])) for beta in betas] for gamma in gammas]
+        assert np.allclose(grid, expected)
+
+
+class TestSimulation:
+    def test_mixer_explicit(self):
+        """ Tests that factorized application of the mixer matches the explicit mixer matrix built as Kronecker product of single-qubit rotations. """
+        num_qubits = 4
+        rng = np.random.default_rng(0)
+        betas = rng.uniform(-np.pi, np.pi, num_qubits)
+        psi = rng.normal(size=2 ** num_qubits) + 1j * rng.normal(size=2 ** num_qubits)
+        mixer = reduce(np.kron, [get_exp_x(beta) for beta in betas])
+        assert np.allclose(apply_mixer_individual(betas, psi), mixer @ psi)
+
+    def test_qaoa_layer_explicit(self):
+        """ Tests that fused QAOA layer with X and Y mixers matches explicit driver and mixer matrices built from closed-form single-qubit rotations. """
+        num_qubits = 4
+        terms = [np.array([0, 1]), np.array([1, 3]), np.array([2])]
+        rng = np.random.default_rng(1)
+        gammas = rng.uniform(-np.pi, np.pi, len(terms))
+        betas = rng.uniform(-np.pi, np.pi, num_qubits)
+        psi = rng.normal(size=2 ** num_qubits) + 1j * rng.normal(size=2 ** num_qubits)
+        term_vals = np.array([evaluate_z_term(term, num_qubits) for term in terms])
+        driver = np.exp(-1j * gammas @ term_vals)
+        mixer = reduce(np.kron, [get_exp_y(beta) @ get_exp_x(beta) for beta in betas])
+        expected = mixer @ (driver * psi)
+        assert np.allclose(apply_qaoa_layer(gammas, betas, term_vals, psi, True), expected)
+        assert np.allclose(apply_qaoa_layer_masks(gammas, betas, get_z_term_masks(terms, num_qubits), psi, True), expected)
+
+    def test_simulation_gradient(self):
+        """ Tests that adjoint gradient of simulated MA-QAOA and QAOA expectations matches finite differences for p=2. """
+        graph = nx.gnp_random_graph(6, 0.5, seed=1)
+        nx.set_edge_attributes(graph, 1, 'weight')
+        for search_space in ['ma', 'qaoa']:
+            evaluator = Evaluator.get_evaluator_standard_maxcut(graph, 2, search_space=search_space)
+            angles = np.random.default_rng(0).uniform(-np.pi, np.pi, evaluator.num_angles)
+            assert np.allclose(evaluator.grad(angles), optimize.approx_fprime(angles, evaluator.func, 1e-7), atol=1e-5)
+
+    def test_simulation_batched(self):
+        """ Tests that batched evaluation matches evaluation of each set of angles for driver terms given by values and by masks, with and without Y mixers. """
+        num_qubits = 5
+        terms = [np.array([0, 1]), np.array([1, 3]), np.array([2, 4]), np.array([0, 4])]
+        term_vals = np.array([evaluate_z_term(term, num_qubits) for term in terms])
+        target_vals = np.random.default_rng(2).normal(size=2 ** num_qubits)
+        evaluators = []
+        for search_space in ['ma', 'xqaoa', 'qaoa']:
+            evaluators.append(Evaluator.get_evaluator_general(target_vals, term_vals, 2, search_space))
+            evaluators.append(Evaluator.get_evaluator_general_masks(target_vals, get_z_term_masks(terms, num_qubits), 2, search_space))
+        for evaluator in evaluators:
+            angles_batch = np.random.default_rng(3).uniform(-np.pi, np.pi, (4, evaluator.num_angles))
+            assert np.allclose(evaluator.func_batch(angles_batch), [evaluator.func(angles) for angles in angles_batch])
+
+
+PARALLEL_CHECK_SCRIPT = """
+import networkx as nx
+import numpy as np
+from src.optimization import Evaluator, optimize_qaoa_angles
+graph = nx.random_regular_graph(3, 8, seed=0)
+nx.set_edge_attributes(graph, 1, 'weight')
+evaluator = Evaluator.get_evaluator_standard_maxcut(graph, 2, search_space='qaoa')
+result_serial = optimize_qaoa_angles(evaluator, num_restarts=4, seed=0)
+result_parallel = optimize_qaoa_angles(evaluator, num_restarts=4, seed=0, num_workers=2)
+assert np.isclose(result_serial.fun, result_parallel.fun), (result_serial.fun, result_parallel.fun)
+"""
+
+
+class TestOptimization:
+    @pytest.fixture
+    def evaluator(self, weighted_gnp):
+        """ Analytical QAOA evaluator for p=1 on a weighted random graph. """
+        return Evaluator.get_evaluator_standard_maxcut_analytical(weighted_gnp, use_multi_angle=False)
+
+    @pytest.fixture
+    def objective_best(self, evaluator):
+        """ Best QAOA objective found with many restarts. """
+        return -optimize_qaoa_angles(evaluator, num_restarts=10, seed=0).fun
+
+    def test_restarts_early_stopping(self, evaluator, objective_best):
+        """ Tests that patience and time budget stop restarts early and keep the best result. """
+        result = optimize_qaoa_angles(evaluator, num_restarts=10, seed=0, patience=2)
+        assert abs(-result.fun - objective_best) < 1e-6
+        result = optimize_qaoa_angles(evaluator, num_restarts=10, seed=0, time_budget=0)
+        assert result.fun == optimize_qaoa_angles(evaluator, seed=0).fun
+
+    @pytest.mark.parametrize('threading_layer', ['workqueue', 'default'])
+    def test_parallel_restarts(self, threading_layer):
+        """ Tests that restarts in worker processes (or in the current process if workers cannot be forked) give the same result as sequential restarts.
+        Runs in a separate process, since the result depends on numba's threading layer. """
+        env = os.environ | {'NUMBA_THREADING_LAYER': threading_layer}
+        process = subprocess.run([sys.executable, '-c', PARALLEL_CHECK_SCRIPT], cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True,
+                                 text=True, timeout=600)
+        assert process.returncode == 0, process.stderr
+
+    def test_basinhopping(self, evaluator, objective_best):
+        """ Tests that seeded basin-hopping is reproducible and finds the best objective. """
+        results = [optimize_qaoa_angles(evaluator, num_restarts=5, strategy='basinhopping', seed=1) for _ in range(2)]
+        assert results[0].fun == results[1].fun
+        assert abs(-results[0].fun - objective_best) < 1e-6
+
+    def test_cma(self, evaluator, objective_best):
+        """ Tests that CMA-ES accepts the options passed to local optimizers and finds the best objective. """
+        pytest.importorskip('cma')
+        maxint = np.iinfo(np.int32).max
+        result = optimize_qaoa_angles(evaluator, strategy='cma', seed=1, options={'maxiter': 200, 'maxfun': maxint})
+        assert abs(-result.fun - objective_best) < 1e-4
+
+    def test_disk_cache(self, evaluator, tmp_path):
+        """ Tests that seeded results are read from the disk cache and runs limited by time are not cached. """
+        cache_args = {'cache_dir': str(tmp_path), 'cache_key': ('test', 1, 'qaoa')}
+        result = optimize_qaoa_angles(evaluator, num_restarts=2, seed=0, **cache_args)
+        assert len(list(tmp_path.iterdir())) == 1
+        result_cached = optimize_qaoa_angles(Evaluator(None, evaluator.num_angles), num_restarts=2, seed=0, **cache_args)
+        assert result_cached.fun == result.fun and np.array_equal(result_cached.x, result.x)
+        optimize_qaoa_angles(evaluator, num_restarts=2, seed=0, time_budget=60, **cache_args)
+        assert len(list(tmp_path.iterdir())) == 1